@@ -0,0 +1,190 @@
+#!/usr/bin/python
+
+# Adaptive time stepping for the billiard simulator.
+#
+# simulation_step is sized for the fastest ball (1000 cm/s moves 0.1 cm per step), but drag slows the balls
+# down and most of a run is spent with slow balls far away from each other and from the walls. This engine
+# looks at the current speeds and the clearance between the balls and to the walls, and when no collision
+# is possible for the next m steps it jumps over all of them at once instead of checking every pair m times.
+#
+# The size of a jump is the largest m such that
+#   - no ball moves more than max_travel_fraction * ball_radius
+#   - for every pair, the two balls together move less than the gap between them (distance - 2 * ball_radius)
+#   - every ball moves less than its distance to the walls
+#   - it does not pass a step on which the recorder or the checkpointer wants the state
+#   - it is at most max_jump steps
+# If m is 1 or less, a normal step of billiard_engine is done (this is what happens around every collision).
+#
+# A jump uses the same closed form as billiard_events: each step the velocity is multiplied by
+# r = 1 - ball_slowdown_constant * simulation_step, so after j steps the ball moved
+# v0 * simulation_step * (1 - r^j) / (1 - r). This is exact, not an approximation with a larger time step,
+# so the only difference from the stepped engine is floating point rounding. max_jump caps how much rounding
+# a single jump can accumulate. See TOLERANCE in billiard_events.py for how that rounding behaves over a run.
+#
+# "steps" in the stats still counts simulation steps (the same number as the stepped engine), "saved_steps"
+# counts how many of them were jumped over instead of simulated.
+
+import math
+
+import billiard_engine
+from billiard_engine import ball_radius, brute_force_pairs, grid_pairs, DrawClock
+from billiard_events import decay_rate, steps_to_stop, travel, travel_steps
+
+# No ball moves further than this fraction of ball_radius in one jump
+max_travel_fraction = 0.5
+
+# Longest jump, in steps (1 simulated second)
+max_jump = 10000
+
+# Clearance kept back so that rounding in the closed form can never make balls touch
+clearance_margin = 1e-6
+
+# Returns the longest jump (in steps) that can not skip over a collision
+# The jump is limited by the fastest ball, the gaps between pairs of balls and the distances to the walls
+# stats is optional, its "pair_tests" count is increased for every pair of balls whose gap is checked
+def safe_jump(width, length, ball_list, broadphase="brute", stats=None):
+    speeds = [math.sqrt(ball.x_velocity ** 2 + ball.y_velocity ** 2) for ball in ball_list]
+    fastest = max(speeds)
+    if (fastest == 0):
+        return 0
+
+    # Furthest (per unit of speed) any ball may travel in the jump
+    reach = max_travel_fraction * ball_radius
+    limit = reach / fastest
+
+    # Walls: a ball must not reach a wall
+    for i in range(0, len(ball_list)):
+        if (speeds[i] == 0):
+            continue
+        ball = ball_list[i]
+        clearance = min(ball.x - ball_radius, length - ball.x - ball_radius, ball.y - ball_radius, width - ball.y - ball_radius)
+        limit = min(limit, (clearance - clearance_margin) / speeds[i])
+    if (limit <= 0):
+        return 0
+
+    # Pairs: two balls must not close their gap. Balls further apart than 2 * (ball_radius + reach) can not
+    # close it in one jump, so the grid only needs to find the pairs closer than that
+    if (broadphase == "grid"):
+        pairs = grid_pairs(ball_list, 2 * (ball_radius + reach))
+    else:
+        pairs = brute_force_pairs(ball_list)
+    tests = 0
+    for (tests, (i, j)) in enumerate(pairs, 1):
+        closing = speeds[i] + speeds[j]
+        if (closing == 0):
+            continue
+        first = ball_list[i]
+        second = ball_list[j]
+        gap = math.sqrt((second.x - first.x) ** 2 + (second.y - first.y) ** 2) - 2 * ball_radius
+        limit = min(limit, (gap - clearance_margin) / closing)
+        if (limit <= 0):
+            break
+    if (stats is not None):
+        stats["pair_tests"] = stats.get("pair_tests", 0) + tests
+    if (limit <= 0):
+        return 0
+
+    # Largest number of steps whose travel is within the limit
+    steps = travel_steps(limit)
+    if (steps is None):
+        return max_jump
+    return min(int(math.floor(steps)), max_jump)
+
+# Moves every ball "steps" steps ahead without any collisions, with the closed form of billiard_events
+# Returns: the number of steps until the last ball stopped, or "steps" if some are still moving
+def jump(ball_list, steps):
+    decay = decay_rate ** steps
+    moved = 0
+    for ball in ball_list:
+        if (ball.x_velocity == 0 and ball.y_velocity == 0):
+            continue
+        stop = steps_to_stop(ball.x_velocity, ball.y_velocity)
+        moved = max(moved, min(steps, stop))
+        distance = travel(min(steps, stop))
+        ball.x = ball.x + ball.x_velocity * distance
+        ball.y = ball.y + ball.y_velocity * distance
+        if (steps >= stop):
+            # Same as update_vectors once the ball falls below cutoff_velocity
+            ball.x_velocity = 0
+            ball.y_velocity = 0
+        else:
+            ball.x_velocity = ball.x_velocity * decay
+            ball.y_velocity = ball.y_velocity * decay
+    return moved
+
+# Returns the number of steps from "step" to the next multiple of "every" (every <= 0 means never)
+def steps_to_multiple(step, every):
+    if (every <= 0):
+        return max_jump
+    return every - step % every
+
+# This is the main simulation loop of the adaptive engine. It runs until all balls stop
+# Same arguments and return value as billiard_engine.simulate, "saved_steps" is also added to stats
+# "pair_tests" in stats also counts the pairs checked by safe_jump
+# The profiler phases are those of billiard_engine, plus "search" (safe_jump) and "jump"
+def simulate(width, length, ball_list, draw_callback=None, broadphase="brute", stats=None, recorder=None, checkpointer=None, start_step=0, max_steps=None, profiler=None):
+    if (stats is None and (recorder is not None or checkpointer is not None)):
+        # The recorder needs to know which steps had collisions, checkpoints store the counts
+        stats = {}
+    if (stats is not None):
+        stats.setdefault("steps", 0)
+        stats.setdefault("collisions", 0)
+        stats.setdefault("saved_steps", 0)
+        stats.setdefault("pair_tests", 0)
+        stats.setdefault("wall_bounces", 0)
+    if (recorder is not None):
+        recorder.record(start_step, ball_list)
+
+    # The phases of a step. With a profiler, each of them is timed
+    (search, jump_ahead, pairs, walls, integrate, moving) = (safe_jump, jump, billiard_engine.pair_detect, billiard_engine.wall_detect, billiard_engine.update_vectors, billiard_engine.detect_movement)
+    if (profiler is not None):
+        (search, jump_ahead) = (profiler.timed("search", search), profiler.timed("jump", jump_ahead))
+        (pairs, walls, integrate, moving) = (profiler.timed("pairs", pairs), profiler.timed("walls", walls), profiler.timed("integrate", integrate), profiler.timed("movement", moving))
+        if (draw_callback is not None):
+            draw_callback = profiler.timed("draw", draw_callback)
+
+    steps = start_step
+    saved = 0
+    clock = DrawClock()
+    while (moving(ball_list) and (max_steps is None or steps < max_steps)):
+        jump_steps = search(width, length, ball_list, broadphase, stats)
+        if (max_steps is not None):
+            jump_steps = min(jump_steps, max_steps - steps)
+        # Do not jump over a step that is recorded or checkpointed
+        if (recorder is not None):
+            jump_steps = min(jump_steps, steps_to_multiple(steps, recorder.every))
+        if (checkpointer is not None):
+            jump_steps = min(jump_steps, steps_to_multiple(steps, checkpointer.every))
+
+        if (recorder is not None):
+            collisions = stats["collisions"]
+        if (jump_steps > 1):
+            # The simulation ends with the step the last ball stops on, which can be inside the jump
+            jump_steps = jump_ahead(ball_list, jump_steps)
+            saved = saved + jump_steps - 1
+        else:
+            jump_steps = 1
+            # Update velocities on collision
+            pairs(ball_list, broadphase, stats)
+            walls(width, length, ball_list, stats)
+            integrate(ball_list) # Compute new positions and velocities
+        steps = steps + jump_steps
+
+        if (recorder is not None and recorder.wants(steps, stats["collisions"] != collisions)):
+            recorder.record(steps, ball_list)
+        if (checkpointer is not None and checkpointer.wants(steps)):
+            if (recorder is not None):
+                # Frames up to the checkpoint must be on disk before it, a resumed run appends after them
+                recorder.flush()
+            checkpointer.save(steps, width, length, ball_list, dict(stats, steps=stats["steps"] + steps - start_step, saved_steps=stats["saved_steps"] + saved))
+        # Draw the data, at most every draw_interval seconds
+        if (draw_callback is not None and clock.due()):
+            draw_callback(width, length, ball_list)
+
+    if (recorder is not None):
+        # Always finish with the final state
+        recorder.record(steps, ball_list)
+    if (stats is not None):
+        stats["steps"] = stats["steps"] + steps - start_step
+        stats["saved_steps"] = stats["saved_steps"] + saved
+    return ball_list
@@ -0,0 +1,135 @@
+#!/usr/bin/python
+
+# Batch runner for the billiard simulator
+# Runs the headless engine on many table files, spread over a pool of worker processes (one per core by default).
+# Each result is written to the output directory under the same name as its input file, and a summary
+# line (steps, collisions, wall-clock time) is printed and appended to the summary file as each run completes.
+#
+# Running:
+#   ./billiard_batch.py [--engine E] [--broadphase B] [--output-dir DIR] [--processes N] inputs...
+# where inputs are files, directories (every file in them) or glob patterns
+
+import sys
+import os
+import glob
+import time
+import argparse
+import multiprocessing
+
+from billiard_io import read_table, write_table
+from billiard_simulation import engineMap, stepEngines
+from billiard_engine import broadphaseMap
+
+# Columns of the summary file
+# saved_steps is the number of steps the adaptive engine jumped over (0 for the other engines)
+summary_columns = ["file", "status", "balls", "steps", "saved_steps", "collisions", "seconds"]
+
+# Expands the input arguments into a sorted list of files
+# Args: patterns - a list of files, directories or glob patterns
+# Returns: a list of file paths, without duplicates
+def find_inputs(patterns):
+    files = set()
+    for pattern in patterns:
+        if (os.path.isdir(pattern)):
+            for name in os.listdir(pattern):
+                path = os.path.join(pattern, name)
+                if (os.path.isfile(path)):
+                    files.add(path)
+        else:
+            for path in glob.glob(pattern):
+                if (os.path.isfile(path)):
+                    files.add(path)
+    return sorted(files)
+
+# Simulates one table. This runs in a worker process
+# Args: job - a tuple (input path, output path, engine, broadphase)
+# Returns: a dictionary with an entry for each of summary_columns
+def run_table(job):
+    (input_path, output_path, engine, broadphase) = job
+    result = {"file": input_path, "status": "ok", "balls": 0, "steps": 0, "saved_steps": 0, "collisions": 0, "seconds": 0.0}
+    try:
+        (length, width, ball_list) = read_table(input_path)
+        result["balls"] = len(ball_list)
+
+        stats = {}
+        options = {"stats": stats}
+        if (broadphase is not None):
+            options["broadphase"] = broadphase
+        start = time.time()
+        engineMap[engine](width, length, ball_list, **options)
+        result["seconds"] = time.time() - start
+        result["steps"] = stats["steps"]
+        result["saved_steps"] = stats.get("saved_steps", 0)
+        result["collisions"] = stats["collisions"]
+
+        write_table(output_path, length, width, ball_list)
+    except AssertionError, e:
+        result["status"] = "error: %s" % e.args[0]
+    except Exception, e:
+        result["status"] = "error: %s" % e
+    return result
+
+# Formats a result as a line of the summary file
+def summary_line(result):
+    return ",".join([str(result[column]) for column in summary_columns])
+
+# Parses the command line arguments
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Run the billiard simulator on many table files")
+    parser.add_argument("inputs", nargs="+", help="input files, directories or glob patterns")
+    parser.add_argument("--output-dir", default="test_outputs", help="where the results are written (default: test_outputs)")
+    parser.add_argument("--summary", help="summary file (default: <output-dir>/summary.csv)")
+    parser.add_argument("--processes", type=int, default=multiprocessing.cpu_count(), help="number of worker processes (default: number of cores)")
+    parser.add_argument("--engine", choices=sorted(engineMap.keys()), default="stepped", help="simulation engine (default: stepped)")
+    parser.add_argument("--broadphase", choices=sorted(broadphaseMap.keys()), help="broadphase of the stepped, adaptive and numpy engines")
+    args = parser.parse_args(argv)
+    if (args.engine == "parallel"):
+        # Pool workers are daemonic and cannot start processes, every run would silently be serial
+        parser.error("the parallel engine cannot run inside the worker pool, use --processes to run tables side by side")
+    return args
+
+def main():
+    args = parse_args(sys.argv[1:])
+
+    inputs = find_inputs(args.inputs)
+    if (not inputs):
+        sys.exit("Error: No input files found")
+    if (not os.path.isdir(args.output_dir)):
+        os.makedirs(args.output_dir)
+    summaryPath = args.summary
+    if (summaryPath is None):
+        summaryPath = os.path.join(args.output_dir, "summary.csv")
+
+    broadphase = args.broadphase
+    if (args.engine not in stepEngines):
+        broadphase = None
+    jobs = [(path, os.path.join(args.output_dir, os.path.basename(path)), args.engine, broadphase) for path in inputs]
+
+    summary = open(summaryPath, "w")
+    summary.write(",".join(summary_columns) + "\n")
+    failed = 0
+    start = time.time()
+    pool = multiprocessing.Pool(max(1, min(args.processes, len(jobs))))
+    try:
+        # Results are written as soon as each run completes, in whatever order they finish
+        for result in pool.imap_unordered(run_table, jobs):
+            line = summary_line(result)
+            print line
+            summary.write(line + "\n")
+            summary.flush()
+            if (result["status"] != "ok"):
+                failed = failed + 1
+        pool.close()
+    except KeyboardInterrupt:
+        pool.terminate()
+        summary.close()
+        sys.exit("Interrupted")
+    pool.join()
+    summary.close()
+
+    print "Simulated %d files (%d failed) in %.2fs. Summary written to %s" % (len(jobs), failed, time.time() - start, summaryPath)
+    if (failed > 0):
+        sys.exit(-1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,276 @@
+#!/usr/bin/python
+
+# Benchmark suite for the billiard simulator
+# Generates reproducible random tables (from a seed, a number of balls and a density), runs every engine and
+# broadphase on them headless and writes the results to a JSON file, so throughput can be tracked over time.
+#
+# For every table and engine the results contain:
+#   steps, steps_per_second         - simulation steps done, and per second of wall-clock time
+#   pair_tests, pair_tests_per_second - pairs of balls checked for a collision (see "pair_tests" in the engines)
+#   collisions, wall_bounces        - ball-ball collisions and bounces off the walls
+#   peak_memory_kb                  - peak resident memory of the process that ran the simulation
+#   processes_used                  - worker processes the run used (1 for every engine but parallel)
+#   divergence                      - largest distance (in cm) between a final ball position and the position
+#                                     given by the reference engine (the stepped engine) on the same table
+#
+# Tables do not run until every ball stops (that takes about 700000 steps), every engine stops after --steps steps.
+# Each run is done in a new worker process, one at a time, so that the runs do not share memory or cores.
+# The worker is not daemonic, so the parallel engine can start its own processes in it. Parallel runs that fell
+# back to the serial engine (see billiard_parallel.py) are listed with status "fallback".
+# Runs of brute force broadphases and of the event engine check every pair of balls, on tables with more than
+# --quadratic-limit balls they are skipped (and listed with status "skipped").
+#
+# Running:
+#   ./billiard_benchmark.py [--balls 4,100,1000,10000] [--densities 0.01,0.1,0.3] [--steps N] [--seed S]
+#                           [--engines stepped,event,...] [--output benchmark.json] [--tables DIR]
+
+import sys
+import os
+import math
+import json
+import time
+import random
+import hashlib
+import resource
+import platform
+import argparse
+import multiprocessing
+
+import billiard_engine
+from billiard_engine import Ball, ball_radius, broadphaseMap
+from billiard_io import write_table
+from billiard_simulation import engineMap, stepEngines
+
+# The engine and broadphase every other run is compared against. The grid gives the same results as brute force
+reference_engine = ("stepped", "grid")
+
+# Version of the JSON layout, increased when fields change meaning (or a seed gives different tables)
+benchmark_version = 3
+
+# Fastest initial speed of a generated ball, in cm/s
+max_speed = 1000.0
+
+# Generates a random table, the same one for the same arguments
+# Args: seed - random seed, balls - number of balls, density - fraction of the table area covered by balls
+# Returns: (length, width, ball_list). The table is twice as long as it is wide, like the test inputs
+# Raises ValueError if the density is too high to place the balls without overlaps
+def generate_table(seed, balls, density):
+    assert (balls > 0), "Number of balls must be positive"
+    assert (density > 0 and density < 1), "Density must be between 0 and 1"
+    # Seeding Random with a string uses hash(), which differs between builds and with -R, so use an integer
+    rng = random.Random(int(hashlib.sha1("%d,%d,%r" % (seed, balls, density)).hexdigest()[:16], 16))
+
+    area = balls * math.pi * ball_radius ** 2 / density
+    width = max(int(math.ceil(math.sqrt(area / 2))), 2 * ball_radius + 1)
+    length = max(int(math.ceil(area / width)), 2 * ball_radius + 1)
+
+    # Cut the table into square slots of at least one ball, and put each ball at a random place in its own slot,
+    # so no two balls overlap. Half of the slots are left empty when there is room, so the balls are not in a lattice
+    slot = max(math.sqrt(float(length * width) / (2 * balls)), 2 * ball_radius + 0.01)
+    columns = int(length // slot)
+    rows = int(width // slot)
+    if (columns * rows < balls):
+        raise ValueError("Cannot fit %d balls on a %dx%d table, use a lower density" % (balls, length, width))
+    room = slot - 2 * ball_radius
+
+    ball_list = []
+    for index in rng.sample(xrange(columns * rows), balls):
+        (column, row) = divmod(index, rows)
+        x = column * slot + ball_radius + rng.uniform(0, room)
+        y = row * slot + ball_radius + rng.uniform(0, room)
+        angle = rng.uniform(0, 2 * math.pi)
+        speed = rng.uniform(0, max_speed)
+        ball_list.append(Ball(x, y, speed * math.cos(angle), speed * math.sin(angle)))
+    return length, width, ball_list
+
+# Returns the peak resident memory of this process, in KB
+def peak_memory():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if (sys.platform == "darwin"):
+        # Reported in bytes on Mac OS
+        peak = peak / 1024
+    return peak
+
+# Runs one engine on one table. This runs in its own worker process, see run_isolated
+# Args: job - a tuple (seed, balls, density, engine, broadphase, steps)
+# Returns: a dictionary with the measurements, and the final positions under "positions"
+def run_case(job):
+    (seed, balls, density, engine, broadphase, steps) = job
+    (length, width, ball_list) = generate_table(seed, balls, density)
+
+    stats = {}
+    options = {"stats": stats, "max_steps": steps}
+    if (broadphase is not None):
+        options["broadphase"] = broadphase
+    start = time.time()
+    engineMap[engine](width, length, ball_list, **options)
+    seconds = time.time() - start
+
+    return {
+        "steps"         : stats["steps"],
+        "seconds"       : seconds,
+        "pair_tests"    : stats["pair_tests"],
+        "collisions"    : stats["collisions"],
+        "wall_bounces"  : stats["wall_bounces"],
+        "saved_steps"   : stats.get("saved_steps", 0),
+        "peak_memory_kb": peak_memory(),
+        "processes_used": stats.get("processes", 1),
+        "positions"     : [(ball.x, ball.y) for ball in ball_list]
+    }
+
+# The body of a worker process of run_isolated: sends ("ok", result) or ("error", message) through "connection"
+def case_worker(connection, job):
+    try:
+        connection.send(("ok", run_case(job)))
+    except Exception, e:
+        connection.send(("error", str(e)))
+    connection.close()
+
+# Runs run_case(job) in a new process, which exits afterwards, so peak memory is measured for that run alone.
+# The process is not daemonic (unlike the workers of multiprocessing.Pool), so the parallel engine can use its cores
+# Returns: the result of run_case
+# Raises RuntimeError if the run failed or its process died
+def run_isolated(job):
+    (parent, child) = multiprocessing.Pipe(False)
+    worker = multiprocessing.Process(target=case_worker, args=(child, job))
+    worker.start()
+    # Only the worker writes to the pipe, so recv() fails instead of waiting forever if it dies
+    child.close()
+    try:
+        (status, result) = parent.recv()
+    except EOFError:
+        (status, result) = ("died", None)
+    except KeyboardInterrupt:
+        worker.terminate()
+        raise
+    finally:
+        worker.join()
+        parent.close()
+    if (status == "died"):
+        raise RuntimeError("worker process exited with code %s" % worker.exitcode)
+    if (status != "ok"):
+        raise RuntimeError(result)
+    return result
+
+# Returns the largest distance between two lists of (x, y) positions
+def divergence(positions, reference):
+    return max([0.0] + [math.hypot(x - ref_x, y - ref_y) for ((x, y), (ref_x, ref_y)) in zip(positions, reference)])
+
+# Returns every (engine, broadphase) combination of the given engines, with the reference first
+# broadphase is None for engines that do not take one
+def engine_cases(engines):
+    cases = [reference_engine]
+    for engine in engines:
+        if (engine in stepEngines):
+            for broadphase in sorted(broadphaseMap.keys()):
+                if ((engine, broadphase) != reference_engine):
+                    cases.append((engine, broadphase))
+        else:
+            cases.append((engine, None))
+    return cases
+
+# Returns True if a run checks every pair of balls (on every step or every event)
+def quadratic(engine, broadphase):
+    return broadphase == "brute" or engine == "event"
+
+# Parses a comma separated list, with "parse" applied to every value
+def parse_list(value, parse):
+    try:
+        return [parse(item) for item in value.split(",") if item]
+    except ValueError:
+        raise argparse.ArgumentTypeError("invalid list %r" % value)
+
+# Parses the command line arguments
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Benchmark the billiard simulator engines on random tables")
+    parser.add_argument("--balls", type=lambda value: parse_list(value, int), default=[4, 100, 1000, 10000], help="numbers of balls (default: 4,100,1000,10000)")
+    parser.add_argument("--densities", type=lambda value: parse_list(value, float), default=[0.01, 0.1, 0.3], help="fractions of the table covered by balls (default: 0.01,0.1,0.3)")
+    parser.add_argument("--steps", type=int, default=500, help="simulation steps per run (default: 500)")
+    parser.add_argument("--seed", type=int, default=444, help="random seed of the tables (default: 444)")
+    parser.add_argument("--engines", type=lambda value: parse_list(value, str), default=sorted(engineMap.keys()), help="engines to run (default: all)")
+    parser.add_argument("--quadratic-limit", type=int, default=200, help="skip brute force and event engine runs on tables with more balls (default: 200)")
+    parser.add_argument("--output", default="benchmark.json", help="where the results are written (default: benchmark.json)")
+    parser.add_argument("--tables", metavar="DIR", help="also write the generated tables to this directory, in the input file format")
+    args = parser.parse_args(argv)
+    for engine in args.engines:
+        if (engine not in engineMap):
+            parser.error("unknown engine %s (choose from %s)" % (engine, ", ".join(sorted(engineMap.keys()))))
+    return args
+
+def main():
+    args = parse_args(sys.argv[1:])
+    if (args.tables is not None and not os.path.isdir(args.tables)):
+        os.makedirs(args.tables)
+
+    report = {
+        "version"   : benchmark_version,
+        "created"   : time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python"    : platform.python_version(),
+        "machine"   : platform.platform(),
+        "processor" : platform.processor(),
+        "constants" : {
+            "ball_radius"           : billiard_engine.ball_radius,
+            "ball_slowdown_constant": billiard_engine.ball_slowdown_constant,
+            "cutoff_velocity"       : billiard_engine.cutoff_velocity,
+            "simulation_step"       : billiard_engine.simulation_step
+        },
+        "options"   : {"seed": args.seed, "steps": args.steps, "quadratic_limit": args.quadratic_limit},
+        "reference" : {"engine": reference_engine[0], "broadphase": reference_engine[1]},
+        "results"   : []
+    }
+
+    try:
+        for balls in args.balls:
+            for density in args.densities:
+                try:
+                    (length, width, ball_list) = generate_table(args.seed, balls, density)
+                except (AssertionError, ValueError), e:
+                    print "Skipping %d balls at density %g: %s" % (balls, density, e)
+                    continue
+                table = "random-%d-%d-%g" % (args.seed, balls, density)
+                if (args.tables is not None):
+                    write_table(os.path.join(args.tables, table + ".txt"), length, width, ball_list)
+
+                reference = None
+                for (engine, broadphase) in engine_cases(args.engines):
+                    result = {"table": table, "seed": args.seed, "balls": balls, "density": density,
+                              "length": length, "width": width, "engine": engine, "broadphase": broadphase, "status": "ok"}
+                    if (quadratic(engine, broadphase) and balls > args.quadratic_limit):
+                        result["status"] = "skipped"
+                    else:
+                        try:
+                            result.update(run_isolated((args.seed, balls, density, engine, broadphase, args.steps)))
+                        except Exception, e:
+                            result["status"] = "error: %s" % e
+                        if (result["status"] == "ok" and engine == "parallel" and result["processes_used"] < 2):
+                            result["status"] = "fallback"
+                    if (result["status"] in ("ok", "fallback")):
+                        positions = result.pop("positions")
+                        if ((engine, broadphase) == reference_engine):
+                            reference = positions
+                        result["divergence"] = None
+                        if (reference is not None):
+                            result["divergence"] = divergence(positions, reference)
+                        result["steps_per_second"] = result["steps"] / max(result["seconds"], 1e-9)
+                        result["pair_tests_per_second"] = result["pair_tests"] / max(result["seconds"], 1e-9)
+                        print "%-24s %-8s %-5s %8d steps %10.1f steps/s %12.0f pairs/s %6d collisions %8d KB %2d proc  divergence %.3g cm%s" % (
+                            table, engine, broadphase or "-", result["steps"], result["steps_per_second"], result["pair_tests_per_second"],
+                            result["collisions"], result["peak_memory_kb"], result["processes_used"],
+                            result["divergence"] if result["divergence"] is not None else float("nan"),
+                            " (fallback)" if result["status"] == "fallback" else "")
+                    else:
+                        print "%-24s %-8s %-5s %s" % (table, engine, broadphase or "-", result["status"])
+                    report["results"].append(result)
+    except KeyboardInterrupt:
+        sys.exit("Interrupted")
+
+    output_file = open(args.output, "w")
+    try:
+        json.dump(report, output_file, indent=2, sort_keys=True)
+        output_file.write("\n")
+    finally:
+        output_file.close()
+    print "Results written to %s" % args.output
+
+if __name__ == "__main__":
+    main()
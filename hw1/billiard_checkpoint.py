@@ -0,0 +1,90 @@
+#!/usr/bin/python
+
+# Checkpoints for long billiard simulations
+#
+# The simulate() loop of the stepped, adaptive, numpy and parallel engines can save its full state (ball positions
+# and velocities, step counter, simulated time, table size, constants and stats) every N steps. A run that
+# is restarted from a checkpoint continues with exactly the same numbers, so its final output is
+# bit-identical to a run that was never interrupted.
+#
+# A checkpoint is a pickled dictionary. It is written to a temporary file and renamed over the previous
+# checkpoint, so the file on disk is always a complete checkpoint even if the process dies mid-write.
+
+import os
+import cPickle as pickle
+
+import billiard_engine
+from billiard_engine import Ball
+
+checkpoint_version = 1
+
+# The constants a checkpoint was made with. Resuming with different constants would not reproduce the run
+def constants():
+    return {
+        "ball_radius"               : billiard_engine.ball_radius,
+        "ball_slowdown_constant"    : billiard_engine.ball_slowdown_constant,
+        "cutoff_velocity"           : billiard_engine.cutoff_velocity,
+        "simulation_step"           : billiard_engine.simulation_step
+    }
+
+# Saves the state of a simulation every "every" steps
+# Args: path - the checkpoint file, engine - the name of the engine (a key of engineMap), every - steps between checkpoints
+class Checkpointer:
+    def __init__(self, path, engine, every=100000):
+        self.path = path
+        self.engine = engine
+        self.every = every
+        self.saved = 0
+
+    # Returns True if a checkpoint should be saved after this step
+    def wants(self, step):
+        return step % self.every == 0
+
+    # Saves a checkpoint from a list of balls
+    def save(self, step, width, length, ball_list, stats):
+        self.save_values(step, width, length,
+                         [ball.x for ball in ball_list], [ball.y for ball in ball_list],
+                         [ball.x_velocity for ball in ball_list], [ball.y_velocity for ball in ball_list], stats)
+
+    # Saves a checkpoint from lists of positions and velocities
+    def save_values(self, step, width, length, x, y, x_velocity, y_velocity, stats):
+        state = {
+            "version"       : checkpoint_version,
+            "engine"        : self.engine,
+            "step"          : step,
+            "time"          : step * billiard_engine.simulation_step,
+            "length"        : length,
+            "width"         : width,
+            "constants"     : constants(),
+            "x"             : x,
+            "y"             : y,
+            "x_velocity"    : x_velocity,
+            "y_velocity"    : y_velocity,
+            "stats"         : dict(stats)
+        }
+        temp = self.path + ".tmp"
+        checkpoint_file = open(temp, "wb")
+        pickle.dump(state, checkpoint_file, pickle.HIGHEST_PROTOCOL)
+        checkpoint_file.flush()
+        os.fsync(checkpoint_file.fileno())
+        checkpoint_file.close()
+        os.rename(temp, self.path)
+        self.saved = self.saved + 1
+
+# Loads a checkpoint
+# Returns: the checkpoint dictionary. Raises ValueError if it cannot be resumed by this version of the simulator
+def load_checkpoint(path):
+    checkpoint_file = open(path, "rb")
+    try:
+        state = pickle.load(checkpoint_file)
+    finally:
+        checkpoint_file.close()
+    if (not isinstance(state, dict) or state.get("version") != checkpoint_version):
+        raise ValueError("%s is not a checkpoint of this version of the simulator" % path)
+    if (state["constants"] != constants()):
+        raise ValueError("%s was made with different simulation constants %r" % (path, state["constants"]))
+    return state
+
+# Returns the balls stored in a checkpoint
+def checkpoint_balls(state):
+    return [Ball(state["x"][i], state["y"][i], state["x_velocity"][i], state["y_velocity"][i]) for i in range(0, len(state["x"]))]
@@ -0,0 +1,429 @@
+#!/usr/bin/python
+
+# Physics engine for the billiard simulator.
+# Contains no GUI code, so it can be imported and run on machines without a display
+
+import math
+import heapq
+import itertools
+from timeit import default_timer as timer
+
+# Define constants
+ball_radius = 5 # In cm
+ball_slowdown_constant = 0.1 # Ball loses 10% of its velocity per second
+cutoff_velocity = 0.1 # If velocity falls below this, it is set to 0
+simulation_step = 0.0001 # In seconds. Max velocity of 1000 cm/s means the ball will move a max of 0.1cm per simulation step
+
+# Default number of steps between two recorded frames (--record-every)
+record_rate = 500
+
+# Seconds of wall-clock time between two calls of the draw callback of simulate(). The engines check the clock every
+# step and hand over the latest state once it is due, however many steps that is. The GUI draws the newest state it
+# was given at its own frame rate (see billiard_renderer.FrameQueue); no display refreshes faster than this
+draw_interval = 1.0 / 240
+
+# Define our ball class, to store our x and y positions, and velocities
+class Ball:
+    def __init__(self,x_position, y_position, x_velocity, y_velocity):
+        self.x = x_position
+        self.y = y_position
+        self.x_velocity = x_velocity
+        self.y_velocity = y_velocity
+
+# Tells a simulation loop when its draw callback is due, on a wall-clock budget
+class DrawClock:
+    def __init__(self, interval=draw_interval):
+        self.interval = interval
+        self.next_draw = 0
+
+    # Returns True, and starts the next interval, if a frame is due
+    def due(self):
+        now = timer()
+        if (now < self.next_draw):
+            return False
+        self.next_draw = now + self.interval
+        return True
+
+# Computes the new velocities of two colliding balls (elastic collision, equal mass)
+# The velocity components along the line between the centres are swapped, the tangent components are kept
+# first, second = the two balls. x_distance, y_distance, distance = vector (and its length) from first to second
+def bounce(first, second, x_distance, y_distance, distance):
+    normal_v = [x_distance / distance, y_distance / distance]
+    tangent_v = [-1 * normal_v[1], normal_v[0]]
+
+    # Project x and y vectors onto normal and tangent (first ball)
+    dot_product_n = normal_v[0] * first.x_velocity + normal_v[1] * first.y_velocity
+    first_normal_v = [dot_product_n * normal_v[0] , dot_product_n * normal_v[1]]
+    dot_product_t = tangent_v[0] * first.x_velocity + tangent_v[1] * first.y_velocity
+    first_tangent_v = [dot_product_t * tangent_v[0] , dot_product_t * tangent_v[1]]
+
+    # Project x and y vectors onto normal and tangent (second ball)
+    dot_product_n = normal_v[0] * second.x_velocity + normal_v[1] * second.y_velocity
+    second_normal_v = [dot_product_n * normal_v[0] , dot_product_n * normal_v[1]]
+    dot_product_t = tangent_v[0] * second.x_velocity + tangent_v[1] * second.y_velocity
+    second_tangent_v = [dot_product_t * tangent_v[0] , dot_product_t * tangent_v[1]]
+
+    # Swap the normal vectors
+    temp = first_normal_v
+    first_normal_v = second_normal_v
+    second_normal_v = temp
+
+    # Combine back to x and y
+    first.x_velocity = first_normal_v[0] + first_tangent_v[0]
+    first.y_velocity = first_normal_v[1] + first_tangent_v[1]
+    second.x_velocity = second_normal_v[0] + second_tangent_v[0]
+    second.y_velocity = second_normal_v[1] + second_tangent_v[1]
+
+# Checks if two balls are colliding and computes their new velocities if they are
+# Returns True if there was a collision
+def collide(first, second):
+    # Compute x and y distance between balls
+    x_distance = second.x - first.x
+    y_distance = second.y - first.y
+    # Balls that are further apart than 2 radii cannot collide. Comparing the squares first
+    # saves the square roots below for almost every pair
+    squared_distance = x_distance * x_distance + y_distance * y_distance
+    if (squared_distance >= 4 * ball_radius * ball_radius):
+        return False
+    # Compute total distance
+    distance = math.sqrt(squared_distance)
+
+    # First, simulate what happens if we do nothing
+    # Compute the new distance (experimental_distance) between the two balls on the next simulation step
+    # If this value (experimental_distance) is less than the current distance AND the balls are
+    # currently overlapping, we know that the collision was supposed to occur.
+    experiment_x_distance = (second.x + second.x_velocity * simulation_step) - (first.x + first.x_velocity * simulation_step)
+    experiment_y_distance = (second.y + second.y_velocity * simulation_step) - (first.y + first.y_velocity * simulation_step)
+    experiment_distance =  math.sqrt(experiment_x_distance ** 2 + experiment_y_distance ** 2)
+
+    if (distance < 2 * ball_radius and (experiment_distance < distance)):
+        # Collision detected
+        bounce(first, second, x_distance, y_distance, distance)
+        return True
+    return False
+
+# Broadphase: returns every pair (i, j) with i < j, in increasing order
+def brute_force_pairs(ball_list):
+    return itertools.combinations(range(0, len(ball_list)), 2)
+
+# Width of a cell of the grid broadphase. Balls closer than 2 radii are always in the same or neighbouring cells
+grid_cell_size = 2 * ball_radius
+
+# Returns the grid cell that a position falls in
+def grid_cell(x, y, cell_size=grid_cell_size):
+    return (int(math.floor(x / cell_size)), int(math.floor(y / cell_size)))
+
+# Broadphase: puts the balls in a uniform grid and returns only the pairs (i, j) with i < j in the same or
+# neighbouring cells, in increasing order. Every pair that brute_force_pairs would find colliding is included
+# cell_size can be made larger to also find every pair of balls whose centres are less than cell_size apart
+def grid_pairs(ball_list, cell_size=grid_cell_size):
+    grid = {}
+    for i in range(0, len(ball_list)):
+        grid.setdefault(grid_cell(ball_list[i].x, ball_list[i].y, cell_size), []).append(i)
+
+    # Handle the collisions in the same order as the brute force path, so the results are identical
+    pairs = grid_cell_pairs(grid)
+    pairs.sort()
+    return pairs
+
+# Returns the pairs (i, j) with i < j of the balls in the same or neighbouring cells of a grid (unsorted)
+# grid maps each cell to the balls in it, in increasing order
+def grid_cell_pairs(grid):
+    pairs = []
+    for ((cell_x, cell_y), cell) in grid.iteritems():
+        # Pairs in the same cell. Balls were added in order, so i < j already
+        for a in range(0, len(cell)):
+            for b in range(a+1, len(cell)):
+                pairs.append((cell[a], cell[b]))
+        # Pairs with the neighbouring cells. Only half of the neighbours are visited, the other
+        # half visit this cell, so that every pair of cells is only looked at once
+        for (offset_x, offset_y) in ((1, -1), (1, 0), (1, 1), (0, 1)):
+            neighbour = grid.get((cell_x + offset_x, cell_y + offset_y))
+            if (neighbour is None):
+                continue
+            for i in cell:
+                for j in neighbour:
+                    if (i < j):
+                        pairs.append((i, j))
+                    else:
+                        pairs.append((j, i))
+    return pairs
+
+# Maps the broadphase option to the function that finds the candidate pairs
+broadphaseMap = {
+    "brute" : brute_force_pairs,    # Every pair, O(N^2)
+    "grid"  : grid_pairs            # Uniform grid with 2 * ball_radius cells
+}
+
+# Checks position of all balls, computes new velocities if there is a collision
+# Width = width of table, length = length of table, ball_list is a list of all balls
+# broadphase = a key of broadphaseMap, picks how the pairs of balls to check are found
+# stats = optional dictionary, its "collisions" count is increased for every ball-ball collision,
+# its "pair_tests" count for every pair of balls that is checked and its "wall_bounces" count for every wall bounce
+def collision_detect(width, length, ball_list, broadphase="brute", stats=None):
+    pair_detect(ball_list, broadphase, stats)
+    wall_detect(width, length, ball_list, stats)
+    return ball_list
+
+# Detect collision with balls. Same arguments as collision_detect
+def pair_detect(ball_list, broadphase="brute", stats=None):
+    if (stats is None):
+        for (i, j) in broadphaseMap[broadphase](ball_list):
+            collide(ball_list[i], ball_list[j])
+    else:
+        tests = 0
+        for (tests, (i, j)) in enumerate(broadphaseMap[broadphase](ball_list), 1):
+            if (collide(ball_list[i], ball_list[j])):
+                stats["collisions"] = stats["collisions"] + 1
+        stats["pair_tests"] = stats.get("pair_tests", 0) + tests
+    return ball_list
+
+# Detect collision with walls
+# We first check if the ball is overlapping with the wall
+# We then check if the ball is moving towards the wall
+# If both conditions are right, we need to reflect the ball
+# stats is optional, its "wall_bounces" count is increased for every bounce
+def wall_detect(width, length, ball_list, stats=None):
+    for ball in ball_list:
+        # Left or Right wall collision, reverse X velocity
+        if (((ball.x - ball_radius) < 0 and ball.x_velocity < 0) or ((ball.x + ball_radius)  > length and ball.x_velocity > 0)):
+            ball.x_velocity = -1 * ball.x_velocity
+            if (stats is not None):
+                stats["wall_bounces"] = stats.get("wall_bounces", 0) + 1
+        # Up or Down wal collision, reverse Y velocity
+        if (((ball.y - ball_radius) < 0 and ball.y_velocity < 0) or ((ball.y + ball_radius)  > width and ball.y_velocity > 0)):
+            ball.y_velocity = -1 * ball.y_velocity
+            if (stats is not None):
+                stats["wall_bounces"] = stats.get("wall_bounces", 0) + 1
+    return ball_list
+
+# Update x and y coords of all balls based on velocities
+def update_vectors(ball_list):
+    for ball in ball_list:
+        # New position = Position + Velocity * Time. Compute for both X and Y
+        ball.x = ball.x + ball.x_velocity * simulation_step
+        ball.y = ball.y + ball.y_velocity * simulation_step
+
+        # Based on v_new = v_old + constant_factor*acceleration*time
+        # New velocity = Velocity - Velocity * ball_slowdown_constant * simulation_step
+        # If velocity is less than cutoff_velocity, set it to 0
+        velocity_magnitude = math.sqrt(ball.x_velocity ** 2 + ball.y_velocity ** 2)
+        if (velocity_magnitude < cutoff_velocity):
+            ball.x_velocity = 0
+            ball.y_velocity = 0
+        else:
+            ball.x_velocity = ball.x_velocity - ball_slowdown_constant * ball.x_velocity * simulation_step
+            ball.y_velocity = ball.y_velocity - ball_slowdown_constant * ball.y_velocity * simulation_step
+
+    return ball_list
+
+# Stopped balls have a velocity of int 0, engines that store velocities as floats use this to write the same output
+def plain_number(value):
+    if (value == 0):
+        return 0
+    return float(value)
+
+# Check if the balls are moving. This is how we detect when the simulation is complete
+def detect_movement(ball_list):
+    for ball in ball_list:
+        # If the ball has non-zero x or y velocity, we detect movement
+        if (abs(ball.x_velocity) > 0 or abs(ball.y_velocity) > 0):
+            return True
+    return False
+
+# Tracks which balls are moving, so that balls at rest cost nothing
+# A ball is asleep once its velocity is 0: it does not move and is not checked against the walls, and a pair of
+# sleeping balls is never checked because they cannot collide. A ball is woken when a moving ball collides with
+# it. Sleeping balls stay in a grid (or one list for the brute force broadphase), so the moving balls find them
+# without looking at the whole table.
+# The pairs are still handled in (i, j) order. When a collision wakes a ball, its pairs with sleeping balls that
+# come later in that order are checked in the same step, so the results are identical to checking every pair.
+# The methods are the phases of simulate(), with the same stats as pair_detect and wall_detect
+class ActiveSet:
+    def __init__(self, ball_list, broadphase="brute"):
+        self.ball_list = ball_list
+        self.broadphase = broadphase
+        self.use_grid = (broadphase == "grid")
+        self.awake = [ball.x_velocity != 0 or ball.y_velocity != 0 for ball in ball_list]
+        # Indices of the moving balls, in increasing order
+        self.active = [i for i in range(0, len(ball_list)) if self.awake[i]]
+        # Cell (or None without the grid) -> set of the sleeping balls in it
+        self.sleeping = {}
+        for i in range(0, len(ball_list)):
+            if (not self.awake[i]):
+                self.sleep(i)
+
+    def cell(self, i):
+        if (self.use_grid):
+            return grid_cell(self.ball_list[i].x, self.ball_list[i].y)
+        return None
+
+    def sleep(self, i):
+        self.awake[i] = False
+        self.sleeping.setdefault(self.cell(i), set()).add(i)
+
+    def wake(self, i):
+        self.awake[i] = True
+        cell = self.cell(i)
+        self.sleeping[cell].discard(i)
+        if (not self.sleeping[cell]):
+            del self.sleeping[cell]
+
+    # Returns the sleeping balls that ball i could collide with: the ones in the same or neighbouring cells
+    def sleeping_near(self, i):
+        if (not self.use_grid):
+            return self.sleeping.get(None, ())
+        (cell_x, cell_y) = self.cell(i)
+        near = []
+        for offset_x in (-1, 0, 1):
+            for offset_y in (-1, 0, 1):
+                near.extend(self.sleeping.get((cell_x + offset_x, cell_y + offset_y), ()))
+        return near
+
+    # Returns True if any ball is moving
+    def moving(self):
+        return len(self.active) > 0
+
+    # Returns the pairs (i, j) with i < j of two moving balls or a moving and a sleeping ball that could collide
+    def candidate_pairs(self):
+        ball_list = self.ball_list
+        active = self.active
+        if (not self.use_grid):
+            pairs = [(active[a], active[b]) for (a, b) in broadphaseMap[self.broadphase]([ball_list[i] for i in active])]
+            for i in active:
+                for j in self.sleeping.get(None, ()):
+                    pairs.append((min(i, j), max(i, j)))
+            return pairs
+
+        grid = {}
+        for i in active:
+            grid.setdefault(grid_cell(ball_list[i].x, ball_list[i].y), []).append(i)
+        pairs = grid_cell_pairs(grid)
+        # Every cell of moving balls is matched with the cells of sleeping balls around it. The cells are looked
+        # up from whichever side has fewer of them
+        (near, far) = (grid, self.sleeping)
+        if (len(self.sleeping) < len(grid)):
+            (near, far) = (self.sleeping, grid)
+        for ((cell_x, cell_y), cell) in near.iteritems():
+            for offset_x in (-1, 0, 1):
+                for offset_y in (-1, 0, 1):
+                    for j in far.get((cell_x + offset_x, cell_y + offset_y), ()):
+                        for i in cell:
+                            if (i < j):
+                                pairs.append((i, j))
+                            else:
+                                pairs.append((j, i))
+        return pairs
+
+    # Collisions between balls, like pair_detect
+    def pair_detect(self, stats=None):
+        ball_list = self.ball_list
+        active = self.active
+        pairs = self.candidate_pairs()
+        pairs.sort()
+
+        # Pairs of balls woken in this step, merged in order
+        woken_pairs = []
+        woken = []
+        tests = 0
+        collisions = 0
+        k = 0
+        while (k < len(pairs) or woken_pairs):
+            if (woken_pairs and (k == len(pairs) or woken_pairs[0] < pairs[k])):
+                pair = heapq.heappop(woken_pairs)
+            else:
+                pair = pairs[k]
+                k = k + 1
+            tests = tests + 1
+            if (not collide(ball_list[pair[0]], ball_list[pair[1]])):
+                continue
+            collisions = collisions + 1
+            for i in pair:
+                if (self.awake[i]):
+                    continue
+                self.wake(i)
+                woken.append(i)
+                for j in self.sleeping_near(i):
+                    later = (min(i, j), max(i, j))
+                    if (later > pair):
+                        heapq.heappush(woken_pairs, later)
+
+        if (woken):
+            self.active = sorted(active + woken)
+        if (stats is not None):
+            stats["collisions"] = stats["collisions"] + collisions
+            stats["pair_tests"] = stats.get("pair_tests", 0) + tests
+
+    # Collisions with the walls, like wall_detect
+    def wall_detect(self, width, length, stats=None):
+        wall_detect(width, length, [self.ball_list[i] for i in self.active], stats)
+
+    # New positions and velocities, like update_vectors. Balls that stopped go to sleep
+    def update_vectors(self):
+        ball_list = self.ball_list
+        update_vectors([ball_list[i] for i in self.active])
+        still_moving = []
+        for i in self.active:
+            if (ball_list[i].x_velocity != 0 or ball_list[i].y_velocity != 0):
+                still_moving.append(i)
+            else:
+                self.sleep(i)
+        self.active = still_moving
+
+# This is the main simulation loop. It runs until all balls stop
+# draw_callback is optional. If given, it is called as draw_callback(width, length, ball_list)
+# at most every draw_interval seconds (this is how the GUI hooks in). Leave it as None for a headless run
+# broadphase picks how the pairs of moving balls are found (see broadphaseMap). Balls at rest are skipped (see ActiveSet)
+# stats is an optional dictionary, "steps" and "collisions" are added to it
+# recorder is an optional billiard_trajectory.TrajectoryWriter, frames are recorded when it asks for them
+# checkpointer is an optional billiard_checkpoint.Checkpointer, the state is saved when it asks for it
+# start_step is the step the simulation starts on, when it is resumed from a checkpoint
+# max_steps is optional. If given, the simulation stops on that step even if balls are still moving
+# profiler is an optional billiard_profile.Profiler, it times each phase of the loop
+def simulate(width, length, ball_list, draw_callback=None, broadphase="brute", stats=None, recorder=None, checkpointer=None, start_step=0, max_steps=None, profiler=None):
+    if (stats is None and (recorder is not None or checkpointer is not None)):
+        # The recorder needs to know which steps had collisions, checkpoints store the counts
+        stats = {}
+    if (stats is not None):
+        stats.setdefault("steps", 0)
+        stats.setdefault("collisions", 0)
+        stats.setdefault("pair_tests", 0)
+        stats.setdefault("wall_bounces", 0)
+    if (recorder is not None):
+        recorder.record(start_step, ball_list)
+
+    # The phases of a step, only the moving balls take part. With a profiler, each of them is timed
+    active = ActiveSet(ball_list, broadphase)
+    (pairs, walls, integrate, moving) = (active.pair_detect, active.wall_detect, active.update_vectors, active.moving)
+    if (profiler is not None):
+        (pairs, walls, integrate, moving) = (profiler.timed("pairs", pairs), profiler.timed("walls", walls), profiler.timed("integrate", integrate), profiler.timed("movement", moving))
+        if (draw_callback is not None):
+            draw_callback = profiler.timed("draw", draw_callback)
+
+    steps = start_step
+    clock = DrawClock()
+    while (moving() and (max_steps is None or steps < max_steps)):
+        if (recorder is not None):
+            collisions = stats["collisions"]
+        # Update velocities on collision
+        pairs(stats)
+        walls(width, length, stats)
+        integrate() # Compute new positions and velocities
+        steps = steps + 1
+        if (recorder is not None and recorder.wants(steps, stats["collisions"] != collisions)):
+            recorder.record(steps, ball_list)
+        if (checkpointer is not None and checkpointer.wants(steps)):
+            if (recorder is not None):
+                # Frames up to the checkpoint must be on disk before it, a resumed run appends after them
+                recorder.flush()
+            checkpointer.save(steps, width, length, ball_list, dict(stats, steps=stats["steps"] + steps - start_step))
+        # Draw the data. Limited to a frame every draw_interval seconds to speed up program execution
+        if (draw_callback is not None and clock.due()):
+            draw_callback(width, length, ball_list)
+
+    if (recorder is not None):
+        # Always finish with the final state
+        recorder.record(steps, ball_list)
+    if (stats is not None):
+        stats["steps"] = stats["steps"] + steps - start_step
+    return ball_list
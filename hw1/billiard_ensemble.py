@@ -0,0 +1,317 @@
+#!/usr/bin/python
+
+# Monte-Carlo ensembles for the billiard simulator
+# Simulates many variants of one table, each with randomly perturbed initial velocities (and optionally positions),
+# across a pool of worker processes, and keeps aggregated statistics instead of an output file per variant:
+#   - a 2D histogram of the final positions of all balls, and the mean and standard deviation of each ball's
+#     final position
+#   - the time to rest (simulated seconds until every ball stopped): mean, standard deviation, range, histogram
+#   - the number of collisions: mean, standard deviation, range
+# The statistics are printed and rewritten to the output file as variants complete.
+#
+# Variant k is perturbed with its own random generator, seeded from (seed, k), so an ensemble gives the same
+# results however many processes run it and in whatever order the variants finish.
+# With --target-error, variants are added to the statistics in variant order, and the ensemble stops at the first
+# n variants for which the standard error of the mean time to rest is below that fraction of the mean. Variants
+# after those are not counted, even if they finished first, so the result does not depend on the finishing order.
+# Variants still stopping after --max-steps are counted as unfinished.
+#
+# PERTURBATION SPEC: comma separated name=value pairs, all optional (default: speed=0.01,angle=1)
+#   speed=F     - every speed is multiplied by a normal random factor with mean 1 and standard deviation F
+#   angle=D     - every direction is turned by a normal random angle with standard deviation D degrees
+#   position=C  - every position is moved by normal random offsets with standard deviation C cm (kept on the table)
+#
+# Running:
+#   ./billiard_ensemble.py [--variants N] [--seed S] [--perturb SPEC] [--engine E] [--output FILE] input
+
+import sys
+import os
+import math
+import json
+import time
+import random
+import hashlib
+import argparse
+import multiprocessing
+
+import billiard_engine
+from billiard_engine import Ball, ball_radius, broadphaseMap
+from billiard_io import read_table
+from billiard_simulation import engineMap, stepEngines
+
+# --target-error is only checked after this many finished variants, the error estimate is unreliable before that
+min_converged_variants = 30
+
+# Perturbations of the spec and their defaults
+default_perturbation = {"speed": 0.01, "angle": 1.0, "position": 0.0}
+
+# Parses a perturbation spec (see the top of the file)
+# Returns: a dictionary with an entry for each of default_perturbation
+def parse_perturbation(spec):
+    perturbation = dict(default_perturbation)
+    if (spec):
+        for item in spec.split(","):
+            (name, equals, value) = item.partition("=")
+            if (name not in perturbation or not equals):
+                raise ValueError("Unknown perturbation %r (expected %s)" % (item, ", ".join(["%s=VALUE" % key for key in sorted(perturbation)])))
+            perturbation[name] = float(value)
+            if (perturbation[name] < 0):
+                raise ValueError("Perturbation %s must not be negative" % name)
+    return perturbation
+
+# Returns a perturbed copy of the balls of a table for variant k
+def perturb(length, width, ball_list, perturbation, seed, k):
+    # Seeding Random with a string uses hash(), which differs between builds and with -R, so use an integer
+    rng = random.Random(int(hashlib.sha1("%d,%d" % (seed, k)).hexdigest()[:16], 16))
+    variant = []
+    for ball in ball_list:
+        speed = math.hypot(ball.x_velocity, ball.y_velocity) * rng.gauss(1, perturbation["speed"])
+        angle = math.atan2(ball.y_velocity, ball.x_velocity) + math.radians(rng.gauss(0, perturbation["angle"]))
+        x = ball.x
+        y = ball.y
+        if (perturbation["position"] > 0):
+            x = min(max(x + rng.gauss(0, perturbation["position"]), ball_radius), length - ball_radius)
+            y = min(max(y + rng.gauss(0, perturbation["position"]), ball_radius), width - ball_radius)
+        variant.append(Ball(x, y, speed * math.cos(angle), speed * math.sin(angle)))
+    return variant
+
+# Running mean, standard deviation and range of a series of values (Welford's method)
+class RunningStats:
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.squares = 0.0
+        self.minimum = None
+        self.maximum = None
+
+    def add(self, value):
+        self.count = self.count + 1
+        delta = value - self.mean
+        self.mean = self.mean + delta / self.count
+        self.squares = self.squares + delta * (value - self.mean)
+        if (self.minimum is None or value < self.minimum):
+            self.minimum = value
+        if (self.maximum is None or value > self.maximum):
+            self.maximum = value
+
+    def deviation(self):
+        if (self.count < 2):
+            return 0.0
+        return math.sqrt(self.squares / (self.count - 1))
+
+    # Standard error of the mean
+    def error(self):
+        if (self.count < 2):
+            return float("inf")
+        return self.deviation() / math.sqrt(self.count)
+
+    def report(self):
+        return {"count": self.count, "mean": self.mean, "deviation": self.deviation(), "min": self.minimum, "max": self.maximum}
+
+# Counts values in equal width bins over [low, high), values outside go in the first or last bin
+class Histogram:
+    def __init__(self, low, high, bins):
+        self.low = low
+        self.high = high
+        self.counts = [0] * bins
+
+    def bin(self, value):
+        bins = len(self.counts)
+        return min(max(int((value - self.low) / (self.high - self.low) * bins), 0), bins - 1)
+
+    def add(self, value):
+        self.counts[self.bin(value)] += 1
+
+    def report(self):
+        return {"low": self.low, "high": self.high, "counts": self.counts}
+
+# The aggregated statistics of an ensemble
+# Args: length, width - the table size, ball_list - the unperturbed balls, bins - bins of every histogram,
+#       perturbation - the perturbation spec, max_steps - the most steps a variant runs for (or None)
+class EnsembleStats:
+    def __init__(self, length, width, ball_list, bins, perturbation, max_steps):
+        num_balls = len(ball_list)
+        self.length = length
+        self.width = width
+        self.bins = bins
+        self.finished = 0
+        self.unfinished = 0
+        self.failed = 0
+        self.rest_time = RunningStats()
+        self.collisions = RunningStats()
+        self.ball_x = [RunningStats() for i in range(0, num_balls)]
+        self.ball_y = [RunningStats() for i in range(0, num_balls)]
+        # Final positions of all balls: rows are y bins, columns are x bins
+        self.positions = [[0] * bins for row in range(0, bins)]
+        self.position_x = Histogram(0, length, bins)
+        self.position_y = Histogram(0, width, bins)
+        # Time to rest, up to the longest a variant can take. Collisions only exchange speed, so no ball is ever
+        # faster than the total speed of the table (allowing for 4 standard deviations of perturbation)
+        total_speed = math.sqrt(sum([ball.x_velocity ** 2 + ball.y_velocity ** 2 for ball in ball_list])) * (1 + 4 * perturbation["speed"])
+        high = math.log(max(total_speed, billiard_engine.cutoff_velocity) / billiard_engine.cutoff_velocity) / billiard_engine.ball_slowdown_constant
+        if (max_steps is not None):
+            high = min(high, max_steps * billiard_engine.simulation_step)
+        high = max(high, billiard_engine.simulation_step)
+        self.rest_histogram = Histogram(0, high, bins)
+
+    # Adds the result of a variant
+    def add(self, result):
+        if (result["status"] != "ok"):
+            self.failed = self.failed + 1
+            return
+        self.collisions.add(result["collisions"])
+        if (result["moving"]):
+            self.unfinished = self.unfinished + 1
+        else:
+            self.finished = self.finished + 1
+            rest_time = result["steps"] * billiard_engine.simulation_step
+            self.rest_time.add(rest_time)
+            self.rest_histogram.add(rest_time)
+        for (i, (x, y)) in enumerate(result["positions"]):
+            self.ball_x[i].add(x)
+            self.ball_y[i].add(y)
+            self.positions[self.position_y.bin(y)][self.position_x.bin(x)] += 1
+
+    # Returns True once the mean time to rest is known to within target_error (a fraction of the mean)
+    def converged(self, target_error):
+        return self.rest_time.count >= min_converged_variants and self.rest_time.error() <= target_error * self.rest_time.mean
+
+    def report(self):
+        return {
+            "variants"          : self.finished + self.unfinished + self.failed,
+            "finished"          : self.finished,
+            "unfinished"        : self.unfinished,
+            "failed"            : self.failed,
+            "rest_time"         : dict(self.rest_time.report(), error=self.rest_time.error() if self.rest_time.count >= 2 else None, histogram=self.rest_histogram.report()),
+            "collisions"        : self.collisions.report(),
+            "position_histogram": {"x_bins": [self.position_x.low, self.position_x.high], "y_bins": [self.position_y.low, self.position_y.high], "counts": self.positions},
+            "balls"             : [{"x": x.report(), "y": y.report()} for (x, y) in zip(self.ball_x, self.ball_y)]
+        }
+
+    # One line summary of the statistics so far
+    def summary(self):
+        line = "%d variants (%d unfinished, %d failed)" % (self.finished + self.unfinished + self.failed, self.unfinished, self.failed)
+        if (self.rest_time.count > 0):
+            line = line + ", time to rest %.3fs +- %.3fs" % (self.rest_time.mean, self.rest_time.deviation())
+        if (self.collisions.count > 0):
+            line = line + ", collisions %.1f +- %.1f" % (self.collisions.mean, self.collisions.deviation())
+        return line
+
+# Set up by init_worker in every worker process: the table, and how to simulate it
+worker_table = None
+
+def init_worker(table):
+    global worker_table
+    worker_table = table
+
+# Simulates variant k of the table. This runs in a worker process
+# Returns: a dictionary with the status, steps, collisions, final positions and whether balls were still moving
+def run_variant(k):
+    (length, width, ball_list, perturbation, seed, engine, broadphase, max_steps) = worker_table
+    result = {"variant": k, "status": "ok"}
+    try:
+        variant = perturb(length, width, ball_list, perturbation, seed, k)
+        stats = {}
+        options = {"stats": stats}
+        if (broadphase is not None):
+            options["broadphase"] = broadphase
+        if (max_steps is not None):
+            options["max_steps"] = max_steps
+        engineMap[engine](width, length, variant, **options)
+        result["steps"] = stats["steps"]
+        result["collisions"] = stats["collisions"]
+        result["moving"] = billiard_engine.detect_movement(variant)
+        result["positions"] = [(ball.x, ball.y) for ball in variant]
+    except Exception, e:
+        result["status"] = "error: %s" % e
+    return result
+
+# Writes the statistics to a file. Written to a temporary file first, so the file is always complete
+def write_report(path, report):
+    temp = path + ".tmp"
+    output_file = open(temp, "w")
+    try:
+        json.dump(report, output_file, indent=2, sort_keys=True)
+        output_file.write("\n")
+    finally:
+        output_file.close()
+    os.rename(temp, path)
+
+# Parses the command line arguments
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Simulate many randomly perturbed variants of one table and aggregate the results")
+    parser.add_argument("input", help="input table file")
+    parser.add_argument("--variants", type=int, default=1000, help="number of variants (default: 1000)")
+    parser.add_argument("--seed", type=int, default=444, help="random seed of the perturbations (default: 444)")
+    parser.add_argument("--perturb", metavar="SPEC", default="", help="perturbation spec, e.g. speed=0.01,angle=1,position=0 (see billiard_ensemble.py)")
+    parser.add_argument("--max-steps", type=int, help="stop a variant after this many steps (default: when every ball stops)")
+    parser.add_argument("--target-error", type=float, help="stop once the standard error of the mean time to rest is below this fraction of it")
+    parser.add_argument("--bins", type=int, default=20, help="bins of the histograms (default: 20)")
+    parser.add_argument("--output", default="ensemble.json", help="where the statistics are written (default: ensemble.json)")
+    parser.add_argument("--report-every", type=int, default=100, help="rewrite the output file every N variants (default: 100)")
+    parser.add_argument("--processes", type=int, default=multiprocessing.cpu_count(), help="number of worker processes (default: number of cores)")
+    parser.add_argument("--engine", choices=sorted(engineMap.keys()), default="stepped", help="simulation engine (default: stepped)")
+    parser.add_argument("--broadphase", choices=sorted(broadphaseMap.keys()), help="broadphase of the stepped, adaptive and numpy engines")
+    args = parser.parse_args(argv)
+    if (args.report_every < 1):
+        parser.error("--report-every must be at least 1")
+    if (args.engine == "parallel"):
+        # Pool workers are daemonic and cannot start processes, every variant would silently be serial
+        parser.error("the parallel engine cannot run inside the worker pool, use --processes to run variants side by side")
+    return args
+
+def main():
+    args = parse_args(sys.argv[1:])
+    try:
+        perturbation = parse_perturbation(args.perturb)
+        (length, width, ball_list) = read_table(args.input)
+    except IOError, e:
+        sys.exit("I/O error: Cannot read %s" % args.input)
+    except (ValueError, AssertionError), e:
+        sys.exit("Error: %s" % e)
+
+    broadphase = args.broadphase
+    if (args.engine not in stepEngines):
+        broadphase = None
+    table = (length, width, ball_list, perturbation, args.seed, args.engine, broadphase, args.max_steps)
+    stats = EnsembleStats(length, width, ball_list, args.bins, perturbation, args.max_steps)
+    settings = {"input": args.input, "seed": args.seed, "perturbation": perturbation, "engine": args.engine, "broadphase": broadphase, "max_steps": args.max_steps}
+
+    start = time.time()
+    pool = multiprocessing.Pool(max(1, min(args.processes, args.variants)), init_worker, (table,))
+    try:
+        # Variants are handed out lazily, so the ensemble can stop early once the statistics converge.
+        # They are added in variant order (results that finish early wait in "pending"), so an ensemble that
+        # stops early always counts the same variants 0 to n-1
+        pending = {}
+        done = 0
+        converged = False
+        for result in pool.imap_unordered(run_variant, xrange(0, args.variants)):
+            if (result["status"] != "ok"):
+                print "Variant %d: %s" % (result["variant"], result["status"])
+            pending[result["variant"]] = result
+            while (done in pending and not converged):
+                stats.add(pending.pop(done))
+                done = done + 1
+                if (done % args.report_every == 0):
+                    print stats.summary()
+                    write_report(args.output, dict(stats.report(), settings=settings))
+                if (args.target_error is not None and stats.converged(args.target_error)):
+                    print "Time to rest converged after %d variants" % done
+                    converged = True
+            if (converged):
+                break
+        # Stops the variants still running if the ensemble converged early
+        pool.terminate()
+    except KeyboardInterrupt:
+        pool.terminate()
+        write_report(args.output, dict(stats.report(), settings=settings))
+        sys.exit("Interrupted, statistics so far written to %s" % args.output)
+    pool.join()
+
+    write_report(args.output, dict(stats.report(), settings=settings, seconds=time.time() - start))
+    print stats.summary()
+    print "Statistics written to %s in %.2fs" % (args.output, time.time() - start)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,192 @@
+#!/usr/bin/python
+
+# Reading and writing of billiard table files
+#
+# TEXT FORMAT:
+#   length
+#   width
+#   number of balls
+#   x position, y position, x velocity, y velocity    (one line per ball)
+# Anything after the last ball (e.g. a comment) is ignored.
+#
+# BINARY FORMAT (all little endian), for large tables:
+#   header: magic "BTBL", version (uint16), number of balls (uint32), length, width (int64), 6 bytes of padding
+#   balls:  x position, y position, x velocity, y velocity of every ball (float64)
+# The header is binary_header_size (32) bytes, so the ball records are 8 byte aligned and can be read (or memory
+# mapped) by other tools as a flat float64 array, e.g. numpy.memmap(path, "<f8", "r", offset=binary_header_size).
+#
+# Text files are read in chunks of chunk_lines lines, and each chunk is converted in one go, so loading
+# takes time and memory linear in the number of balls. Both formats are validated with the line (or ball)
+# of the first bad value in the error.
+#
+# Running:
+#   ./billiard_io.py input output    - converts a table file (text or binary) to the binary format
+
+import sys
+import struct
+from array import array
+from itertools import islice
+
+from billiard_engine import Ball, ball_radius
+
+# NumPy is optional, it only speeds up the validation of large tables
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+binary_magic = "BTBL"
+binary_version = 2
+binary_header_format = "<4sHIqq6x"
+binary_header_size = struct.calcsize(binary_header_format)
+
+# Number of ball lines converted at a time
+chunk_lines = 65536
+
+# Reads a table file, in the text or binary format
+# Args: path - the path of the input file
+# Returns: (length, width, ball_list)
+# Raises IOError if the file cannot be read, ValueError (with the line number) on non-numerical values
+# and AssertionError (with the line number) if the table or a ball is invalid
+def read_table(path):
+    (length, width, x, y, x_velocity, y_velocity) = read_table_arrays(path)
+    return length, width, map(Ball, x, y, x_velocity, y_velocity)
+
+# Reads a table file, in the text or binary format, into arrays
+# Returns: (length, width, x, y, x_velocity, y_velocity), where the last four are array("d") with one value per ball
+# Raises the same errors as read_table
+def read_table_arrays(path):
+    input_file = open(path, "rb")
+    try:
+        if (input_file.read(len(binary_magic)) == binary_magic):
+            input_file.seek(0)
+            (length, width, values, first) = read_binary(input_file)
+            where = "Ball %d"
+        else:
+            input_file.seek(0)
+            (length, width, values, first) = read_text(input_file)
+            where = "Line %d"
+    finally:
+        input_file.close()
+
+    (x, y, x_velocity, y_velocity) = (values[0::4], values[1::4], values[2::4], values[3::4])
+    bad = first_off_table(x, y, length, width)
+    if (bad is not None):
+        raise AssertionError((where + ": Ball must be on the table") % (first + bad))
+    return length, width, x, y, x_velocity, y_velocity
+
+# Parses the header of a text table
+# Returns: (length, width, number of balls)
+def read_text_header(input_file):
+    header = []
+    for line in range(1, 4):
+        try:
+            header.append(int(input_file.readline()))
+        except ValueError:
+            raise ValueError("Line %d: Non-numerical value specified" % line)
+    (length, width, num_balls) = header
+    assert(length > 0 and width > 0), "Length and width must be greater than 0"
+    assert(num_balls >= 0), "Number of balls must be positive"
+    return length, width, num_balls
+
+# Reads the balls of a text table
+# Returns: (length, width, array of x, y, x velocity, y velocity values (4 per ball), line of the first ball)
+def read_text(input_file):
+    (length, width, num_balls) = read_text_header(input_file)
+    values = array("d")
+    line = 4
+    remaining = num_balls
+    while (remaining > 0):
+        lines = list(islice(input_file, min(remaining, chunk_lines)))
+        if (len(lines) == 0):
+            raise AssertionError("Line %d: Expected %d balls, the file ends after %d" % (line, num_balls, num_balls - remaining))
+        # Convert the whole chunk at once, and only look at the lines one by one if something is wrong
+        try:
+            chunk = map(float, ",".join(lines).split(","))
+        except ValueError:
+            chunk = None
+        if (chunk is None or len(chunk) != 4 * len(lines) or any(text.count(",") != 3 for text in lines)):
+            check_lines(lines, line)
+        values.extend(chunk)
+        line = line + len(lines)
+        remaining = remaining - len(lines)
+    return length, width, values, 4
+
+# Finds the first bad line of a chunk and raises its error
+# Args: lines - the lines of the chunk, first - the line number of lines[0]
+def check_lines(lines, first):
+    for (k, text) in enumerate(lines):
+        try:
+            line_values = map(float, text.split(","))
+        except ValueError:
+            raise ValueError("Line %d: Non-numerical value specified" % (first + k))
+        assert (len(line_values) == 4), "Line %d: Each ball must have exactly 4 values, separated by commas" % (first + k)
+
+# Reads the balls of a binary table
+# Returns: (length, width, array of x, y, x velocity, y velocity values (4 per ball), number of the first ball)
+def read_binary(input_file):
+    header = input_file.read(binary_header_size)
+    assert (len(header) == binary_header_size), "Binary table header is truncated"
+    (magic, version, num_balls, length, width) = struct.unpack(binary_header_format, header)
+    assert (version == binary_version), "Unsupported binary table version %d" % version
+    assert(length > 0 and width > 0), "Length and width must be greater than 0"
+
+    values = array("d")
+    data = input_file.read()
+    assert (len(data) == 4 * values.itemsize * num_balls), "Binary table should have %d balls (%d bytes), it has %d bytes" % (num_balls, 4 * values.itemsize * num_balls, len(data))
+    values.fromstring(data)
+    if (sys.byteorder == "big"):
+        values.byteswap()
+    return length, width, values, 1
+
+# Returns the index of the first ball that is not completely on the table (or has a NaN position), or None
+def first_off_table(x, y, length, width):
+    if (numpy is not None and len(x) > 0):
+        x = numpy.frombuffer(x, dtype=numpy.float64)
+        y = numpy.frombuffer(y, dtype=numpy.float64)
+        on_table = (x - ball_radius >= 0) & (x + ball_radius <= length) & (y - ball_radius >= 0) & (y + ball_radius <= width)
+        bad = numpy.flatnonzero(~on_table)
+        if (len(bad) == 0):
+            return None
+        return int(bad[0])
+    for i in xrange(0, len(x)):
+        if (not (x[i] - ball_radius >= 0 and x[i] + ball_radius <= length and y[i] - ball_radius >= 0 and y[i] + ball_radius <= width)):
+            return i
+    return None
+
+# Writes a table file, in the same format as the input files
+# Args: path - the path of the output file
+#       length, width - the table size
+#       ball_list - the balls to write
+def write_table(path, length, width, ball_list):
+    output_file = open(path, "w")
+    try:
+        output_file.write(str(length) + "\n" + str(width) + "\n" + str(len(ball_list)) + "\n")
+        for ball in ball_list:
+            output_file.write(str(ball.x) + "," + str(ball.y) + "," + str(ball.x_velocity) + "," + str(ball.y_velocity) + "\n")
+    finally:
+        output_file.close()
+
+# Writes a table file in the binary format
+# Args: the same as write_table
+def write_table_binary(path, length, width, ball_list):
+    values = array("d")
+    for ball in ball_list:
+        values.extend((ball.x, ball.y, ball.x_velocity, ball.y_velocity))
+    if (sys.byteorder == "big"):
+        values.byteswap()
+    output_file = open(path, "wb")
+    try:
+        output_file.write(struct.pack(binary_header_format, binary_magic, binary_version, len(ball_list), length, width))
+        output_file.write(values.tostring())
+    finally:
+        output_file.close()
+
+def main():
+    if (len(sys.argv) != 3):
+        sys.exit("Usage: %s input output" % sys.argv[0])
+    (length, width, ball_list) = read_table(sys.argv[1])
+    write_table_binary(sys.argv[2], length, width, ball_list)
+
+if __name__ == "__main__":
+    main()
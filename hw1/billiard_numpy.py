@@ -0,0 +1,243 @@
+#!/usr/bin/python
+
+# NumPy backend for the billiard simulator.
+# Same physics as billiard_engine, but the balls are stored as a structure of arrays (x, y, x_velocity and
+# y_velocity are each one contiguous NumPy array) and every phase of a step is done as whole array operations.
+# Requires NumPy. The results are identical to the stepped engine.
+
+import numpy
+
+from billiard_engine import Ball, collide, plain_number, ball_radius, ball_slowdown_constant, cutoff_velocity, simulation_step, grid_cell_size, DrawClock
+
+# Stores the state of all balls as arrays, index i is ball i of the input
+class BallArrays:
+    def __init__(self, ball_list):
+        self.x = numpy.array([ball.x for ball in ball_list], dtype=numpy.float64)
+        self.y = numpy.array([ball.y for ball in ball_list], dtype=numpy.float64)
+        self.x_velocity = numpy.array([ball.x_velocity for ball in ball_list], dtype=numpy.float64)
+        self.y_velocity = numpy.array([ball.y_velocity for ball in ball_list], dtype=numpy.float64)
+
+    # Copies the state back into a list of Ball objects
+    def to_balls(self, ball_list):
+        for i in range(0, len(ball_list)):
+            ball_list[i].x = float(self.x[i])
+            ball_list[i].y = float(self.y[i])
+            ball_list[i].x_velocity = plain_number(self.x_velocity[i])
+            ball_list[i].y_velocity = plain_number(self.y_velocity[i])
+        return ball_list
+
+# Broadphase: every pair (i, j) with i < j, as two index arrays
+def brute_force_pairs(balls):
+    return numpy.triu_indices(len(balls.x), 1)
+
+# Turns ranges [start, end) of positions in order into (first, second) index arrays:
+# first[k] is paired with every order[p] for p in its range
+def expand_ranges(first, start, end, order):
+    counts = end - start
+    keep = counts > 0
+    first, start, counts = first[keep], start[keep], counts[keep]
+    if (len(counts) == 0):
+        empty = numpy.zeros(0, dtype=numpy.intp)
+        return empty, empty
+    # Position of every pair inside its range: 0, 1, .., counts[k] - 1
+    offsets = numpy.arange(counts.sum()) - numpy.repeat(numpy.cumsum(counts) - counts, counts)
+    return numpy.repeat(first, counts), order[numpy.repeat(start, counts) + offsets]
+
+# Broadphase: uniform grid with the same cells as billiard_engine.grid_pairs, found with a sort and binary
+# searches. Returns index arrays of the pairs (i, j), i < j, in the same or neighbouring cells
+def grid_pairs(balls):
+    cell_x = numpy.floor(balls.x / grid_cell_size).astype(numpy.int64)
+    cell_y = numpy.floor(balls.y / grid_cell_size).astype(numpy.int64)
+    # One number per cell, with room for the neighbouring rows and columns
+    cell_x = cell_x - cell_x.min() + 1
+    cell_y = cell_y - cell_y.min() + 1
+    rows = cell_y.max() + 2
+    key = cell_x * rows + cell_y
+
+    order = numpy.argsort(key, kind="mergesort")
+    sorted_key = key[order]
+    balls_in_order = numpy.arange(len(order))
+
+    # Pairs in the same cell: every ball with the balls after it in the same cell
+    end = numpy.searchsorted(sorted_key, sorted_key, side="right")
+    first, second = expand_ranges(order, balls_in_order + 1, end, order)
+    first_list, second_list = [first], [second]
+
+    # Pairs with half of the neighbouring cells, the other half is covered when the neighbour looks back
+    for (offset_x, offset_y) in ((1, -1), (1, 0), (1, 1), (0, 1)):
+        target = sorted_key + offset_x * rows + offset_y
+        start = numpy.searchsorted(sorted_key, target, side="left")
+        end = numpy.searchsorted(sorted_key, target, side="right")
+        first, second = expand_ranges(order, start, end, order)
+        first_list.append(first)
+        second_list.append(second)
+
+    first = numpy.concatenate(first_list)
+    second = numpy.concatenate(second_list)
+    return numpy.minimum(first, second), numpy.maximum(first, second)
+
+# Maps the broadphase option to the function that finds the candidate pairs
+broadphaseMap = {
+    "brute" : brute_force_pairs,
+    "grid"  : grid_pairs
+}
+
+# Applies billiard_engine.bounce to the pairs (first[k], second[k]) all at once
+# No ball may appear in more than one pair
+def bounce_pairs(balls, first, second, x_distance, y_distance, distance):
+    normal_x = x_distance / distance
+    normal_y = y_distance / distance
+    tangent_x = -1 * normal_y
+    tangent_y = normal_x
+
+    # Project x and y vectors onto normal and tangent (first ball)
+    dot_product_n = normal_x * balls.x_velocity[first] + normal_y * balls.y_velocity[first]
+    first_normal_x, first_normal_y = dot_product_n * normal_x, dot_product_n * normal_y
+    dot_product_t = tangent_x * balls.x_velocity[first] + tangent_y * balls.y_velocity[first]
+    first_tangent_x, first_tangent_y = dot_product_t * tangent_x, dot_product_t * tangent_y
+
+    # Project x and y vectors onto normal and tangent (second ball)
+    dot_product_n = normal_x * balls.x_velocity[second] + normal_y * balls.y_velocity[second]
+    second_normal_x, second_normal_y = dot_product_n * normal_x, dot_product_n * normal_y
+    dot_product_t = tangent_x * balls.x_velocity[second] + tangent_y * balls.y_velocity[second]
+    second_tangent_x, second_tangent_y = dot_product_t * tangent_x, dot_product_t * tangent_y
+
+    # Swap the normal vectors and combine back to x and y
+    balls.x_velocity[first] = second_normal_x + first_tangent_x
+    balls.y_velocity[first] = second_normal_y + first_tangent_y
+    balls.x_velocity[second] = first_normal_x + second_tangent_x
+    balls.y_velocity[second] = first_normal_y + second_tangent_y
+
+# Checks position of all balls, computes new velocities if there is a collision
+# Same rules (and stats) as billiard_engine.collision_detect
+def collision_detect(width, length, balls, broadphase="grid", stats=None):
+    pair_detect(balls, broadphase, stats)
+    wall_detect(width, length, balls, stats)
+    return balls
+
+# Detect collision with balls. Same arguments as collision_detect
+def pair_detect(balls, broadphase="grid", stats=None):
+    first, second = broadphaseMap[broadphase](balls)
+    if (stats is not None):
+        stats["pair_tests"] = stats.get("pair_tests", 0) + len(first)
+
+    # Only keep the pairs that overlap
+    x_distance = balls.x[second] - balls.x[first]
+    y_distance = balls.y[second] - balls.y[first]
+    overlapping = x_distance * x_distance + y_distance * y_distance < 4 * ball_radius * ball_radius
+    first, second = first[overlapping], second[overlapping]
+
+    if (len(first) > 0):
+        # Handle the pairs in the same order as billiard_engine
+        order = numpy.lexsort((second, first))
+        first, second = first[order], second[order]
+        indices = numpy.concatenate((first, second))
+        if (len(numpy.unique(indices)) == len(indices)):
+            # Every ball is in at most one pair, so the pairs do not affect each other
+            x_distance = balls.x[second] - balls.x[first]
+            y_distance = balls.y[second] - balls.y[first]
+            distance = numpy.sqrt(x_distance * x_distance + y_distance * y_distance)
+            experiment_x_distance = (balls.x[second] + balls.x_velocity[second] * simulation_step) - (balls.x[first] + balls.x_velocity[first] * simulation_step)
+            experiment_y_distance = (balls.y[second] + balls.y_velocity[second] * simulation_step) - (balls.y[first] + balls.y_velocity[first] * simulation_step)
+            experiment_distance = numpy.sqrt(experiment_x_distance ** 2 + experiment_y_distance ** 2)
+            hit = (distance < 2 * ball_radius) & (experiment_distance < distance)
+            bounce_pairs(balls, first[hit], second[hit], x_distance[hit], y_distance[hit], distance[hit])
+            if (stats is not None):
+                stats["collisions"] = stats["collisions"] + int(numpy.count_nonzero(hit))
+        else:
+            # A ball touches several others, its new velocity from one pair changes the next pair.
+            # There are only a handful of these pairs, resolve them one at a time
+            for (i, j) in zip(first, second):
+                first_ball = Ball(float(balls.x[i]), float(balls.y[i]), float(balls.x_velocity[i]), float(balls.y_velocity[i]))
+                second_ball = Ball(float(balls.x[j]), float(balls.y[j]), float(balls.x_velocity[j]), float(balls.y_velocity[j]))
+                if (collide(first_ball, second_ball)):
+                    balls.x_velocity[i], balls.y_velocity[i] = first_ball.x_velocity, first_ball.y_velocity
+                    balls.x_velocity[j], balls.y_velocity[j] = second_ball.x_velocity, second_ball.y_velocity
+                    if (stats is not None):
+                        stats["collisions"] = stats["collisions"] + 1
+    return balls
+
+# Detect collision with walls: overlapping with the wall and moving towards it
+# stats is optional, its "wall_bounces" count is increased for every bounce
+def wall_detect(width, length, balls, stats=None):
+    reflect = (((balls.x - ball_radius) < 0) & (balls.x_velocity < 0)) | (((balls.x + ball_radius) > length) & (balls.x_velocity > 0))
+    balls.x_velocity[reflect] = -1 * balls.x_velocity[reflect]
+    bounces = numpy.count_nonzero(reflect)
+    reflect = (((balls.y - ball_radius) < 0) & (balls.y_velocity < 0)) | (((balls.y + ball_radius) > width) & (balls.y_velocity > 0))
+    balls.y_velocity[reflect] = -1 * balls.y_velocity[reflect]
+    if (stats is not None):
+        stats["wall_bounces"] = stats.get("wall_bounces", 0) + int(bounces + numpy.count_nonzero(reflect))
+    return balls
+
+# Update x and y coords of all balls based on velocities, then apply drag and the cutoff velocity
+def update_vectors(balls):
+    balls.x += balls.x_velocity * simulation_step
+    balls.y += balls.y_velocity * simulation_step
+
+    velocity_magnitude = numpy.sqrt(balls.x_velocity ** 2 + balls.y_velocity ** 2)
+    stopped = velocity_magnitude < cutoff_velocity
+    balls.x_velocity = balls.x_velocity - ball_slowdown_constant * balls.x_velocity * simulation_step
+    balls.y_velocity = balls.y_velocity - ball_slowdown_constant * balls.y_velocity * simulation_step
+    balls.x_velocity[stopped] = 0
+    balls.y_velocity[stopped] = 0
+    return balls
+
+# Records the current state as a frame of a billiard_trajectory.TrajectoryWriter
+def record(recorder, step, balls):
+    values = numpy.column_stack((balls.x, balls.y, balls.x_velocity, balls.y_velocity)).astype("<f4")
+    recorder.write_packed(step, values.tostring())
+
+# Check if any ball is moving. This is how we detect when the simulation is complete
+def detect_movement(balls):
+    return bool(numpy.any(balls.x_velocity != 0) or numpy.any(balls.y_velocity != 0))
+
+# This is the main simulation loop of the NumPy backend. It runs until all balls stop
+# Same arguments and return value as billiard_engine.simulate
+def simulate(width, length, ball_list, draw_callback=None, broadphase="grid", stats=None, recorder=None, checkpointer=None, start_step=0, max_steps=None, profiler=None):
+    if (stats is None and (recorder is not None or checkpointer is not None)):
+        # The recorder needs to know which steps had collisions, checkpoints store the counts
+        stats = {}
+    if (stats is not None):
+        stats.setdefault("steps", 0)
+        stats.setdefault("collisions", 0)
+        stats.setdefault("pair_tests", 0)
+        stats.setdefault("wall_bounces", 0)
+
+    balls = BallArrays(ball_list)
+    if (recorder is not None):
+        record(recorder, start_step, balls)
+
+    # The phases of a step. With a profiler, each of them is timed
+    (pairs, walls, integrate, moving) = (pair_detect, wall_detect, update_vectors, detect_movement)
+    if (profiler is not None):
+        (pairs, walls, integrate, moving) = (profiler.timed("pairs", pairs), profiler.timed("walls", walls), profiler.timed("integrate", integrate), profiler.timed("movement", moving))
+        if (draw_callback is not None):
+            draw_callback = profiler.timed("draw", draw_callback)
+
+    steps = start_step
+    clock = DrawClock()
+    while (moving(balls) and (max_steps is None or steps < max_steps)):
+        if (recorder is not None):
+            collisions = stats["collisions"]
+        # Update velocities on collision
+        pairs(balls, broadphase, stats)
+        walls(width, length, balls, stats)
+        integrate(balls) # Compute new positions and velocities
+        steps = steps + 1
+        if (recorder is not None and recorder.wants(steps, stats["collisions"] != collisions)):
+            record(recorder, steps, balls)
+        if (checkpointer is not None and checkpointer.wants(steps)):
+            if (recorder is not None):
+                # Frames up to the checkpoint must be on disk before it, a resumed run appends after them
+                recorder.flush()
+            checkpointer.save_values(steps, width, length, balls.x.tolist(), balls.y.tolist(), balls.x_velocity.tolist(), balls.y_velocity.tolist(), dict(stats, steps=stats["steps"] + steps - start_step))
+        # Draw the data. Limited to a frame every draw_interval seconds to speed up program execution
+        if (draw_callback is not None and clock.due()):
+            draw_callback(width, length, balls.to_balls([Ball(0, 0, 0, 0) for i in range(0, len(ball_list))]))
+
+    if (recorder is not None):
+        # Always finish with the final state
+        record(recorder, steps, balls)
+    if (stats is not None):
+        stats["steps"] = stats["steps"] + steps - start_step
+    return balls.to_balls(ball_list)
@@ -0,0 +1,458 @@
+#!/usr/bin/python
+
+# Partitioned multi-core engine for the billiard simulator.
+#
+# The table is cut into vertical strips (at least 2 * ball_radius wide), and each strip is owned by a worker
+# process, which keeps the balls of its strip as Ball objects of its own. What other processes need to read (the
+# ghosts, the balls that cross into another strip and the balls of collisions across a boundary) goes through
+# shared memory arrays, and the steps are kept in lockstep with semaphores, so nothing is pickled per step.
+# Every ball is only copied to the shared arrays when the coordinator draws, records, checkpoints or finishes.
+# Each step has two phases, and every worker waits for the coordinator's go between them:
+#   detect  - every worker takes the balls that moved into its strip, and finds the pairs of balls that overlap
+#             among its own balls and the "ghost" balls of the next strip that are within 2 * ball_radius of the
+#             boundary (so every pair is found by exactly one worker). Overlapping pairs that share a ball form
+#             groups. A group with no ghost and no ball the previous strip sees as a ghost cannot touch another
+#             worker's balls, and the worker resolves it itself with billiard_engine.collide, in (i, j) order.
+#             It writes the pairs of the other groups to its boundary array, and the coordinator resolves those,
+#             in (i, j) order, once every worker is done.
+#   advance - every worker reflects its own balls off the walls and moves them (billiard_engine.wall_detect and
+#             update_vectors). Then it writes the balls that crossed into another strip, and its balls that are
+#             near its left boundary (the ghosts of the previous strip), to its exchange array.
+# Positions do not change in the detect phase, so the workers do not affect each other. Pairs that do not overlap
+# are not changed by collide(), pairs in different groups have no ball in common, and the pairs of a group are
+# handled in the same order as the stepped engine, so the results are identical to the serial engine.
+#
+# "pair_tests" in the stats counts the pairs the workers checked, which can differ a little from the serial grid.
+# Tables that are too narrow for two strips, tables with fewer than min_strip_balls balls per strip, and runs
+# inside a daemonic process (e.g. a multiprocessing.Pool worker, which cannot start processes of its own) use
+# fewer strips or the serial engine.
+
+import math
+import multiprocessing
+from multiprocessing.sharedctypes import RawArray
+
+import billiard_engine
+from billiard_engine import Ball, collide, plain_number, ball_radius, broadphaseMap, DrawClock
+
+# Fewest balls per strip. Every step, each worker waits twice for the others, which costs about as much as moving
+# 25 balls. With fewer balls per strip the waits take more than the extra cores save
+min_strip_balls = 50
+
+# Commands of the coordinator to the workers, in the shared command value
+(detect_command, advance_command, collect_command, stop_command) = range(0, 4)
+
+# Per strip entries of the shared counters array
+(tests_counter, collisions_counter, bounces_counter, moving_counter, band_counter, left_counter, pairs_counter) = range(0, 7)
+strip_counters = 7
+
+# Largest number of boundary pairs a worker writes to shared memory in one step. If a strip has more (only
+# possible with many overlapping balls), they are sent through its pipe instead
+max_boundary_pairs = 4096
+
+# Seconds between checks that every worker is still alive, while waiting for them to finish a phase
+worker_poll_interval = 0.5
+
+# Returns the strip a ball at x is in (balls slightly off the table belong to the first or last strip)
+def strip_of(x, strip_width, strips):
+    return min(max(int(math.floor(x / strip_width)), 0), strips - 1)
+
+# Returns the balls with index in "indices" as Ball objects, from the shared arrays
+def read_balls(arrays, indices):
+    (x, y, x_velocity, y_velocity) = arrays
+    return [Ball(x[i], y[i], x_velocity[i], y_velocity[i]) for i in indices]
+
+# Writes Ball objects back to the shared arrays, ball_list[k] is ball indices[k]
+def write_balls(arrays, indices, ball_list):
+    (x, y, x_velocity, y_velocity) = arrays
+    for (i, ball) in zip(indices, ball_list):
+        x[i] = ball.x
+        y[i] = ball.y
+        x_velocity[i] = ball.x_velocity
+        y_velocity[i] = ball.y_velocity
+
+# Returns the root of a in a union-find forest, shortening the path on the way
+def find_root(parent, a):
+    while (parent[a] != a):
+        parent[a] = parent[parent[a]]
+        a = parent[a]
+    return a
+
+# The memory that the coordinator and the workers share, set up before the workers start
+class SharedState:
+    def __init__(self, ball_list, strips):
+        self.arrays = tuple([RawArray("d", [getattr(ball, field) for ball in ball_list]) for field in ("x", "y", "x_velocity", "y_velocity")])
+        self.command = RawArray("i", 1)
+        self.failed = RawArray("i", 1)
+        self.counters = RawArray("l", strips * strip_counters)
+        # exchange[s] holds the band of strip s (its balls near its left boundary) followed by the balls that left it
+        self.exchange = [RawArray("i", len(ball_list)) for s in range(0, strips)]
+        # boundary[s] holds the pairs that strip s leaves to the coordinator, as i, j, i, j, ...
+        self.boundary = [RawArray("i", 2 * max_boundary_pairs) for s in range(0, strips)]
+        self.go = [multiprocessing.Semaphore(0) for s in range(0, strips)]
+        self.done = multiprocessing.Semaphore(0)
+
+    # Returns counter "counter" of strip "strip"
+    def counter(self, strip, counter):
+        return self.counters[strip * strip_counters + counter]
+
+    def set_counter(self, strip, counter, value):
+        self.counters[strip * strip_counters + counter] = value
+
+    # Returns (band, balls that left) of strip "strip", as written by its last advance
+    def exchanged(self, strip):
+        band = self.counter(strip, band_counter)
+        left = self.counter(strip, left_counter)
+        exchange = self.exchange[strip]
+        return exchange[0:band], exchange[band:band + left]
+
+    # Writes the band and the balls that left of strip "strip"
+    def set_exchanged(self, strip, band, left):
+        exchange = self.exchange[strip]
+        exchange[0:len(band)] = band
+        exchange[len(band):len(band) + len(left)] = left
+        self.set_counter(strip, band_counter, len(band))
+        self.set_counter(strip, left_counter, len(left))
+
+# The state of a worker process. It owns the balls in strip "strip" and keeps them as Ball objects of its own.
+# The shared arrays only hold what other processes read: the ghosts (its band), the balls that left it,
+# the balls of the groups it leaves to the coordinator, and all of its balls after a collect
+class StripWorker:
+    def __init__(self, connection, shared, strip, strip_width, strips, width, length, broadphase, owned):
+        self.connection = connection
+        self.shared = shared
+        self.strip = strip
+        self.strip_width = strip_width
+        self.strips = strips
+        self.width = width
+        self.length = length
+        self.broadphase = broadphase
+        self.band_edge = strip * strip_width + 2 * ball_radius
+        self.owned = owned
+        self.balls = read_balls(shared.arrays, owned)
+        # Positions in self.balls of the balls whose velocities the coordinator may change in this step
+        self.refresh = []
+
+    # Runs the phase in the shared command every time the go semaphore is released, until the stop command
+    def run(self):
+        commands = {detect_command: self.detect, advance_command: self.advance, collect_command: self.collect}
+        try:
+            while (True):
+                self.shared.go[self.strip].acquire()
+                command = self.shared.command[0]
+                if (command == stop_command):
+                    self.shared.done.release()
+                    return
+                commands[command]()
+        except:
+            # The coordinator would otherwise wait for this worker forever
+            self.shared.failed[0] = 1
+            self.shared.done.release()
+            raise
+
+    # The detect phase, see the top of this file
+    def detect(self):
+        shared = self.shared
+        x = shared.arrays[0]
+        (strip, strips) = (self.strip, self.strips)
+        ghost_edge = (strip + 1) * self.strip_width + 2 * ball_radius
+
+        # Take the balls that moved into this strip. Balls that moved into the next strip near its left boundary
+        # are ghosts too, that strip has not added them to its band yet
+        ghosts = []
+        if (strip + 1 < strips):
+            ghosts.extend(shared.exchanged(strip + 1)[0])
+        for other in range(0, strips):
+            for i in shared.exchanged(other)[1]:
+                new_strip = strip_of(x[i], self.strip_width, strips)
+                if (new_strip == strip):
+                    self.owned.append(i)
+                    self.balls.extend(read_balls(shared.arrays, (i,)))
+                elif (new_strip == strip + 1 and x[i] < ghost_edge):
+                    ghosts.append(i)
+
+        owned = len(self.owned)
+        indices = self.owned + ghosts
+        ball_list = self.balls + read_balls(shared.arrays, ghosts)
+        overlapping = []
+        tests = 0
+        for (a, b) in broadphaseMap[self.broadphase](ball_list):
+            if (a >= owned):
+                # Both are ghosts, the next strip checks this pair
+                continue
+            tests = tests + 1
+            # Same test as the first one of collide()
+            x_distance = ball_list[b].x - ball_list[a].x
+            y_distance = ball_list[b].y - ball_list[a].y
+            if (x_distance * x_distance + y_distance * y_distance < 4 * ball_radius * ball_radius):
+                overlapping.append((a, b))
+
+        # Group the overlapping pairs by shared balls. A group is left to the coordinator if any of its balls is
+        # a ghost, or is seen as a ghost by the previous strip
+        parent = range(0, len(indices))
+        for (a, b) in overlapping:
+            parent[find_root(parent, a)] = find_root(parent, b)
+        shared_roots = set()
+        for (a, b) in overlapping:
+            for c in (a, b):
+                if (c >= owned or (strip > 0 and ball_list[c].x < self.band_edge)):
+                    shared_roots.add(find_root(parent, c))
+        local = []
+        boundary = []
+        # The previous strip can collide its pairs with the band without this worker seeing them
+        refresh = set()
+        if (strip > 0):
+            refresh.update([a for a in range(0, owned) if ball_list[a].x < self.band_edge])
+        for (a, b) in overlapping:
+            # Pairs are handled as (i, j) with i < j, like the serial engine
+            if (indices[a] > indices[b]):
+                (a, b) = (b, a)
+            if (find_root(parent, a) in shared_roots):
+                boundary.append((indices[a], indices[b]))
+                refresh.update([c for c in (a, b) if c < owned])
+            else:
+                local.append((indices[a], indices[b], a, b))
+
+        collisions = 0
+        local.sort()
+        for (i, j, a, b) in local:
+            if (collide(ball_list[a], ball_list[b])):
+                collisions = collisions + 1
+
+        # The coordinator reads and changes the balls of the groups left to it
+        self.refresh = sorted(refresh)
+        write_balls(shared.arrays, [indices[a] for a in self.refresh], [ball_list[a] for a in self.refresh])
+        shared.set_counter(strip, tests_counter, tests)
+        shared.set_counter(strip, collisions_counter, collisions)
+        if (len(boundary) > max_boundary_pairs):
+            shared.set_counter(strip, pairs_counter, -1)
+            shared.done.release()
+            # Sent after the release, the coordinator reads it once every worker is done
+            self.connection.send(boundary)
+        else:
+            pairs = shared.boundary[strip]
+            for k in range(0, len(boundary)):
+                (pairs[2 * k], pairs[2 * k + 1]) = boundary[k]
+            shared.set_counter(strip, pairs_counter, len(boundary))
+            shared.done.release()
+
+    # The advance phase, see the top of this file
+    def advance(self):
+        shared = self.shared
+        (x, y, x_velocity, y_velocity) = shared.arrays
+        for a in self.refresh:
+            i = self.owned[a]
+            (self.balls[a].x_velocity, self.balls[a].y_velocity) = (x_velocity[i], y_velocity[i])
+        counts = {"wall_bounces": 0}
+        billiard_engine.wall_detect(self.width, self.length, self.balls, counts)
+        billiard_engine.update_vectors(self.balls)
+
+        stay = []
+        stay_balls = []
+        band = []
+        band_balls = []
+        left = []
+        left_balls = []
+        for (i, ball) in zip(self.owned, self.balls):
+            if (strip_of(ball.x, self.strip_width, self.strips) != self.strip):
+                left.append(i)
+                left_balls.append(ball)
+            else:
+                stay.append(i)
+                stay_balls.append(ball)
+                if (ball.x < self.band_edge):
+                    band.append(i)
+                    band_balls.append(ball)
+        moving = billiard_engine.detect_movement(self.balls)
+        # Other workers read the ghosts and the balls that arrived from the shared arrays
+        write_balls(shared.arrays, band + left, band_balls + left_balls)
+        (self.owned, self.balls) = (stay, stay_balls)
+
+        shared.set_exchanged(self.strip, band, left)
+        shared.set_counter(self.strip, bounces_counter, counts["wall_bounces"])
+        shared.set_counter(self.strip, moving_counter, int(moving))
+        shared.done.release()
+
+    # Writes every ball of the strip to the shared arrays
+    def collect(self):
+        write_balls(self.shared.arrays, self.owned, self.balls)
+        self.shared.done.release()
+
+# The body of a worker process
+def strip_worker(*args):
+    StripWorker(*args).run()
+
+# Runs the worker processes of a simulation
+class StripPool:
+    def __init__(self, width, length, ball_list, processes, broadphase):
+        self.strips = processes
+        self.strip_width = float(length) / self.strips
+        self.shared = SharedState(ball_list, self.strips)
+        self.arrays = self.shared.arrays
+
+        # Initial owners and bands, after this the workers keep track of them
+        owned = [[] for s in range(0, self.strips)]
+        bands = [[] for s in range(0, self.strips)]
+        for i in range(0, len(ball_list)):
+            strip = strip_of(ball_list[i].x, self.strip_width, self.strips)
+            owned[strip].append(i)
+            if (ball_list[i].x < strip * self.strip_width + 2 * ball_radius):
+                bands[strip].append(i)
+        for strip in range(0, self.strips):
+            self.shared.set_exchanged(strip, bands[strip], [])
+
+        self.connections = []
+        self.workers = []
+        for strip in range(0, self.strips):
+            (parent, child) = multiprocessing.Pipe(False)
+            worker = multiprocessing.Process(target=strip_worker, args=(child, self.shared, strip, self.strip_width, self.strips, width, length, broadphase, owned[strip]))
+            worker.daemon = True
+            worker.start()
+            self.connections.append(parent)
+            self.workers.append(worker)
+
+    # Runs a phase on every worker and waits until all of them are done
+    # Raises RuntimeError if a worker failed, or died without finishing the phase (e.g. it was killed)
+    def run(self, command):
+        self.shared.command[0] = command
+        for go in self.shared.go:
+            go.release()
+        waiting = self.strips
+        while (waiting > 0):
+            if (self.shared.done.acquire(True, worker_poll_interval)):
+                waiting = waiting - 1
+            else:
+                for worker in self.workers:
+                    if (not worker.is_alive()):
+                        raise RuntimeError("A worker process of the parallel engine died (exit code %s)" % worker.exitcode)
+        if (self.shared.failed[0]):
+            raise RuntimeError("A worker process of the parallel engine failed")
+
+    # Finds the overlapping pairs, and resolves the ones that only touch the balls of one strip
+    # Returns: (the pairs (i, j) left to the coordinator, sorted, number of pairs checked, number of collisions)
+    def detect(self):
+        self.run(detect_command)
+        pairs = []
+        tests = 0
+        collisions = 0
+        for strip in range(0, self.strips):
+            tests = tests + self.shared.counter(strip, tests_counter)
+            collisions = collisions + self.shared.counter(strip, collisions_counter)
+            count = self.shared.counter(strip, pairs_counter)
+            if (count < 0):
+                pairs.extend(self.connections[strip].recv())
+            else:
+                values = self.shared.boundary[strip][0:2 * count]
+                pairs.extend(zip(values[0::2], values[1::2]))
+        pairs.sort()
+        return pairs, tests, collisions
+
+    # Moves every ball one step
+    # Returns: (True if any ball is still moving, number of wall bounces)
+    def advance(self):
+        self.run(advance_command)
+        moving = False
+        bounces = 0
+        for strip in range(0, self.strips):
+            moving = moving or bool(self.shared.counter(strip, moving_counter))
+            bounces = bounces + self.shared.counter(strip, bounces_counter)
+        return moving, bounces
+
+    # Returns the current state as a list of balls, with int 0 for stopped balls like billiard_engine
+    def balls(self):
+        self.run(collect_command)
+        ball_list = read_balls(self.arrays, range(0, len(self.arrays[0])))
+        for ball in ball_list:
+            ball.x_velocity = plain_number(ball.x_velocity)
+            ball.y_velocity = plain_number(ball.y_velocity)
+        return ball_list
+
+    def close(self):
+        self.shared.command[0] = stop_command
+        for go in self.shared.go:
+            go.release()
+        for connection in self.connections:
+            connection.close()
+        for worker in self.workers:
+            worker.join()
+
+# Resolves the overlapping pairs in order, with the same rules as billiard_engine.collision_detect
+# Returns: the number of collisions
+def resolve_pairs(arrays, pairs):
+    collisions = 0
+    for (i, j) in pairs:
+        (first, second) = read_balls(arrays, (i, j))
+        if (collide(first, second)):
+            write_balls(arrays, (i, j), (first, second))
+            collisions = collisions + 1
+    return collisions
+
+# This is the main simulation loop of the partitioned engine. It runs until all balls stop
+# Same arguments and return value as billiard_engine.simulate
+# processes is the number of strips (and worker processes), the number of cores by default
+# stats["processes"] is set to the number of worker processes used, 1 if it ran on the serial engine
+# The profiler phases are "detect" and "advance" (waiting for the workers), "resolve" (the pairs across strip
+# boundaries) and "draw"
+def simulate(width, length, ball_list, draw_callback=None, broadphase="grid", stats=None, recorder=None, checkpointer=None, start_step=0, max_steps=None, processes=None, profiler=None):
+    if (processes is None):
+        processes = multiprocessing.cpu_count()
+    # Every strip must be at least 2 * ball_radius wide, so pairs are only ever in neighbouring strips
+    processes = min(processes, int(length // (2 * ball_radius)), len(ball_list) // min_strip_balls)
+    if (processes < 2 or multiprocessing.current_process().daemon):
+        if (stats is not None):
+            stats["processes"] = 1
+        return billiard_engine.simulate(width, length, ball_list, draw_callback, broadphase, stats, recorder, checkpointer, start_step, max_steps, profiler)
+
+    if (stats is None and (recorder is not None or checkpointer is not None)):
+        # The recorder needs to know which steps had collisions, checkpoints store the counts
+        stats = {}
+    if (stats is not None):
+        stats.setdefault("steps", 0)
+        stats.setdefault("collisions", 0)
+        stats.setdefault("pair_tests", 0)
+        stats.setdefault("wall_bounces", 0)
+        stats["processes"] = processes
+    if (recorder is not None):
+        recorder.record(start_step, ball_list)
+
+    pool = StripPool(width, length, ball_list, processes, broadphase)
+    # The phases of a step. With a profiler, each of them is timed
+    (detect, resolve, advance) = (pool.detect, resolve_pairs, pool.advance)
+    if (profiler is not None):
+        (detect, resolve, advance) = (profiler.timed("detect", detect), profiler.timed("resolve", resolve), profiler.timed("advance", advance))
+        if (draw_callback is not None):
+            draw_callback = profiler.timed("draw", draw_callback)
+    try:
+        steps = start_step
+        clock = DrawClock()
+        moving = billiard_engine.detect_movement(ball_list)
+        while (moving and (max_steps is None or steps < max_steps)):
+            (pairs, tests, collisions) = detect() # Collisions inside the strips are resolved by the workers
+            collisions = collisions + resolve(pool.arrays, pairs) # Then the ones across the strip boundaries
+            (moving, bounces) = advance() # Walls, then new positions and velocities
+            steps = steps + 1
+            if (stats is not None):
+                stats["collisions"] = stats["collisions"] + collisions
+                stats["pair_tests"] = stats["pair_tests"] + tests
+                stats["wall_bounces"] = stats["wall_bounces"] + bounces
+            if (recorder is not None and recorder.wants(steps, collisions > 0)):
+                recorder.record(steps, pool.balls())
+            if (checkpointer is not None and checkpointer.wants(steps)):
+                if (recorder is not None):
+                    # Frames up to the checkpoint must be on disk before it, a resumed run appends after them
+                    recorder.flush()
+                checkpointer.save(steps, width, length, pool.balls(), dict(stats, steps=stats["steps"] + steps - start_step))
+            # Draw the data. Limited to a frame every draw_interval seconds to speed up program execution
+            if (draw_callback is not None and clock.due()):
+                draw_callback(width, length, pool.balls())
+
+        for (ball, state) in zip(ball_list, pool.balls()):
+            (ball.x, ball.y, ball.x_velocity, ball.y_velocity) = (state.x, state.y, state.x_velocity, state.y_velocity)
+    finally:
+        pool.close()
+
+    if (recorder is not None):
+        # Always finish with the final state
+        recorder.record(steps, ball_list)
+    if (stats is not None):
+        stats["steps"] = stats["steps"] + steps - start_step
+    return ball_list
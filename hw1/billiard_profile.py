@@ -0,0 +1,79 @@
+#!/usr/bin/python
+
+# Per-phase profiling of the billiard simulator
+#
+# The engines' simulate() take an optional Profiler. When one is given, each phase of the loop (pair tests, wall
+# checks, integration, the movement check, drawing, ...) is wrapped with Profiler.timed, which adds up the time
+# and the number of calls of that phase. Without a profiler the loop calls the plain functions, so profiling
+# costs nothing when it is off.
+# The counters (steps, pair tests, collisions, wall bounces) are the engines' stats dictionary.
+
+import json
+from timeit import default_timer as timer
+
+# Counters of the stats dictionary shown in the summary, in this order
+counter_names = ["steps", "saved_steps", "pair_tests", "collisions", "wall_bounces"]
+
+class Profiler:
+    def __init__(self, engine=None):
+        self.engine = engine
+        self.seconds = {}
+        self.calls = {}
+        self.started = None
+        self.total = 0.0
+
+    # Returns a function that calls "function" and adds its time to "phase"
+    def timed(self, phase, function):
+        seconds = self.seconds
+        calls = self.calls
+        seconds.setdefault(phase, 0.0)
+        calls.setdefault(phase, 0)
+        def timed_function(*args):
+            start = timer()
+            result = function(*args)
+            seconds[phase] = seconds[phase] + timer() - start
+            calls[phase] = calls[phase] + 1
+            return result
+        return timed_function
+
+    # Start and stop of the whole run
+    def start(self):
+        self.started = timer()
+
+    def stop(self):
+        self.total = self.total + timer() - self.started
+
+    # Returns the profile as a dictionary: total seconds, seconds and calls per phase, and the counters from stats
+    def report(self, stats=None):
+        phases = {}
+        for phase in self.seconds:
+            phases[phase] = {"seconds": self.seconds[phase], "calls": self.calls[phase]}
+        counters = {}
+        for name in counter_names:
+            if (stats is not None and name in stats):
+                counters[name] = stats[name]
+        return {"engine": self.engine, "seconds": self.total, "phases": phases, "counters": counters}
+
+    # Returns a readable summary of the profile
+    def summary(self, stats=None):
+        report = self.report(stats)
+        lines = ["Profile of the %s engine: %.3fs" % (self.engine, self.total)]
+        lines.append("  %-12s %10s %7s %10s %12s" % ("phase", "seconds", "share", "calls", "us/call"))
+        for phase in sorted(report["phases"], key=lambda name: -self.seconds[name]):
+            seconds = self.seconds[phase]
+            calls = self.calls[phase]
+            lines.append("  %-12s %10.3f %6.1f%% %10d %12.2f" % (phase, seconds, 100.0 * seconds / max(self.total, 1e-9), calls, 1e6 * seconds / max(calls, 1)))
+        counters = report["counters"]
+        lines.append("  " + ", ".join(["%s %d" % (name.replace("_", " "), counters[name]) for name in counter_names if name in counters]))
+        if (report["phases"].get("render")):
+            lines.append("  render runs in the GUI thread, at the same time as the other phases")
+        return "\n".join(lines)
+
+    # Writes the profile to a JSON file
+    def dump(self, path, stats=None):
+        output_file = open(path, "w")
+        try:
+            json.dump(self.report(stats), output_file, indent=2, sort_keys=True)
+            output_file.write("\n")
+        finally:
+            output_file.close()
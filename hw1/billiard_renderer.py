@@ -0,0 +1,228 @@
+#!/usr/bin/python
+
+# Tkinter renderer for the billiard simulator
+#
+# The physics runs in a worker thread and hands frames (the ball positions) to a FrameQueue, on a wall-clock budget
+# rather than every so many steps. The GUI thread draws the newest frame on its own wall-clock budget
+# (frames_per_second), so drawing never waits for the physics and the physics never waits for drawing: frames the
+# GUI has no time for are dropped.
+# Each ball is one canvas item, created once and moved with canvas.coords, so the canvas does not grow.
+#
+# play() shows a recorded trajectory (see billiard_trajectory.py) instead of running the physics.
+#
+# Only import this module when a GUI is wanted, it needs Tkinter and a display.
+
+import sys
+import threading
+from collections import deque
+from Tkinter import Tk, Frame, Canvas, Scale, Label, SUNKEN, HORIZONTAL, X
+
+from billiard_engine import ball_radius
+
+# Pixels per cm
+gui_scale = 2
+
+# Default number of frames drawn per second of wall-clock time
+frames_per_second = 60
+
+# Frames waiting to be drawn. Older frames are dropped once this many are queued
+max_queued_frames = 4
+
+# Hands frames from the physics thread to the GUI thread
+# push() is the draw_callback of the engines' simulate(). The engines call it on their own wall-clock budget
+# (billiard_engine.draw_interval), more often than the GUI draws, and the GUI draws the newest frame every 1/fps
+# seconds, so what is drawn is never older than one frame
+class FrameQueue:
+    def __init__(self, fps=frames_per_second):
+        self.interval = 1.0 / fps
+        self.frames = deque(maxlen=max_queued_frames)
+        self.lock = threading.Lock()
+
+    # Queues the positions of the balls
+    def push(self, width, length, ball_list):
+        frame = [(ball.x, ball.y) for ball in ball_list]
+        with self.lock:
+            self.frames.append(frame)
+
+    # Queues the positions of the balls outside of a simulation, e.g. the first and final state
+    def push_now(self, ball_list):
+        self.push(0, 0, ball_list)
+
+    # Returns the newest frame and drops the older ones, or None if no frame was queued since the last call
+    def latest(self):
+        with self.lock:
+            if (not self.frames):
+                return None
+            frame = self.frames[-1]
+            self.frames.clear()
+        return frame
+
+# A Tk window with one oval per ball
+class Renderer:
+    def __init__(self, width, length, num_balls, title="Billiards"):
+        self.root = Tk()
+        self.root.title(title)
+        self.root.resizable(0, 0)
+        self.root.protocol("WM_DELETE_WINDOW", self.close)
+        self.closed = False
+
+        frame = Frame(self.root, bd=5, relief=SUNKEN)
+        frame.pack()
+
+        self.canvas = Canvas(frame, width=gui_scale*length, height=gui_scale*width, bd=0, highlightthickness=0)
+        self.canvas.pack()
+        self.canvas.create_rectangle(0, 0, gui_scale*length, gui_scale*width, fill="white")
+        # Created off the table, draw() moves them into place
+        self.ovals = [self.canvas.create_oval(-2 * ball_radius, -2 * ball_radius, 0, 0, fill="blue") for i in range(0, num_balls)]
+        self.root.update()
+
+    # Moves the balls to a frame: a list of (x, y) positions
+    def draw(self, frame):
+        for (oval, (x, y)) in zip(self.ovals, frame):
+            self.canvas.coords(oval, gui_scale*(x - ball_radius), gui_scale*(y - ball_radius), gui_scale*(x + ball_radius), gui_scale*(y + ball_radius))
+
+    # Calls tick() every interval seconds until it returns False or the window is closed
+    def loop(self, tick, interval):
+        def run():
+            if (self.closed):
+                return
+            if (tick()):
+                self.root.after(int(interval * 1000), run)
+            else:
+                self.root.quit()
+        self.root.after(0, run)
+        self.root.mainloop()
+
+    # Closes the window. The simulation carries on without it
+    def close(self):
+        if (not self.closed):
+            self.closed = True
+            self.root.quit()
+            self.root.destroy()
+
+# Runs simulate(width, length, ball_list, draw_callback, **options) in a worker thread, and shows its frames
+# at fps frames per second until it finishes. The window is closed when the simulation is done
+# Returns: the return value of simulate. Exceptions raised by simulate are raised again here
+def run_with_gui(simulate, width, length, ball_list, fps=frames_per_second, **options):
+    frames = FrameQueue(fps)
+    renderer = Renderer(width, length, len(ball_list))
+    if (options.get("profiler") is not None):
+        # Drawing happens in this thread, the engine times the rest
+        renderer.draw = options["profiler"].timed("render", renderer.draw)
+    frames.push_now(ball_list)
+    outcome = {}
+
+    def physics():
+        try:
+            outcome["result"] = simulate(width, length, ball_list, frames.push, **options)
+            frames.push_now(outcome["result"])
+        except:
+            outcome["error"] = sys.exc_info()
+
+    worker = threading.Thread(target=physics, name="physics")
+    # Do not keep the process alive if the GUI thread is interrupted
+    worker.daemon = True
+    worker.start()
+
+    def tick():
+        # Checked before taking the frame, so the final frame is always drawn
+        running = worker.is_alive()
+        frame = frames.latest()
+        if (frame is not None):
+            renderer.draw(frame)
+        return running or frame is not None
+    renderer.loop(tick, frames.interval)
+
+    # Closing the window does not stop the simulation, wait for it to finish
+    while (worker.is_alive()):
+        worker.join(0.1)
+    renderer.close()
+    if ("error" in outcome):
+        (error_type, error, traceback) = outcome["error"]
+        raise error_type, error, traceback
+    return outcome["result"]
+
+# Plays back a trajectory file in a Renderer window, without simulating anything
+# The frames are shown at the simulated time they were recorded at, "speed" simulated seconds per second
+# Keys: space - play/pause, Left/Right - previous/next frame, Up/Down - double/halve the speed,
+#       Home/End - first/last frame. The slider seeks to any frame
+class Player:
+    def __init__(self, reader, speed=1.0, fps=frames_per_second):
+        self.reader = reader
+        self.speed = speed
+        self.interval = 1.0 / fps
+        self.playing = True
+        self.index = 0
+        # Simulated step the playback is at, between two recorded frames while playing
+        self.position = reader.step(0)
+
+        self.renderer = Renderer(reader.width, reader.length, reader.num_balls, "Billiards - playback")
+        root = self.renderer.root
+        self.slider = Scale(root, from_=0, to=len(reader) - 1, orient=HORIZONTAL, showvalue=0, command=self.slide)
+        self.slider.pack(fill=X)
+        self.status = Label(root, anchor="w")
+        self.status.pack(fill=X)
+        root.bind("<space>", lambda event: self.toggle())
+        root.bind("<Right>", lambda event: self.step(1))
+        root.bind("<Left>", lambda event: self.step(-1))
+        root.bind("<Up>", lambda event: self.change_speed(2.0))
+        root.bind("<Down>", lambda event: self.change_speed(0.5))
+        root.bind("<Home>", lambda event: self.seek(0))
+        root.bind("<End>", lambda event: self.seek(len(reader) - 1))
+        self.show()
+
+    # Draws the current frame and updates the slider and status line
+    def show(self):
+        values = self.reader.values(self.index)
+        self.renderer.draw(zip(values[0::4], values[1::4]))
+        self.slider.set(self.index)
+        step = self.reader.step(self.index)
+        state = "playing"
+        if (not self.playing):
+            state = "paused"
+        self.status.config(text="Frame %d/%d  step %d (%.4fs)  speed %gx  %s" % (self.index + 1, len(self.reader), step, step * self.reader.simulation_step, self.speed, state))
+
+    # Jumps to frame k
+    def seek(self, k):
+        self.index = max(0, min(k, len(self.reader) - 1))
+        self.position = self.reader.step(self.index)
+        self.show()
+
+    # Called by the slider when it is moved (and when show() moves it)
+    def slide(self, value):
+        if (int(value) != self.index):
+            self.seek(int(value))
+
+    # Pauses and moves "count" frames forward (or back if negative)
+    def step(self, count):
+        self.playing = False
+        self.seek(self.index + count)
+
+    def toggle(self):
+        self.playing = not self.playing
+        if (self.playing and self.index == len(self.reader) - 1):
+            # Play again from the start
+            self.seek(0)
+        self.show()
+
+    def change_speed(self, factor):
+        self.speed = self.speed * factor
+        self.show()
+
+    # Advances the playback by one display frame. Frames the display has no time for are skipped
+    def tick(self):
+        if (self.playing):
+            self.position = self.position + self.speed * self.interval / self.reader.simulation_step
+            index = self.reader.find_step(int(self.position))
+            if (index == len(self.reader) - 1):
+                self.playing = False
+            if (index != self.index or not self.playing):
+                self.index = index
+                self.show()
+        return True
+
+# Plays back a billiard_trajectory.TrajectoryReader until the window is closed
+def play(reader, speed=1.0, fps=frames_per_second):
+    player = Player(reader, speed, fps)
+    player.renderer.loop(player.tick, player.interval)
+    player.renderer.close()
@@ -0,0 +1,165 @@
+#!/usr/bin/python
+
+# Trajectory files for the billiard simulator
+#
+# A trajectory is an append-only binary file: a small header followed by fixed size frame records,
+# so frame k is always at offset header_size + k * frame_size and a reader can jump to any frame
+# without looking at the ones before it.
+#
+# FORMAT (all little endian):
+#   header: magic "BTRJ", version (uint16), number of balls (uint32),
+#           length, width, simulation_step, ball_radius (float64)
+#   frame:  step (int64), then x, y, x velocity, y velocity of every ball (float32)
+#
+# A partially written frame at the end of the file (e.g. the simulation was killed) is ignored.
+
+import sys
+import os
+import struct
+import mmap
+from array import array
+
+from billiard_engine import Ball, ball_radius, simulation_step
+
+magic = "BTRJ"
+version = 1
+header_format = "<4sHIdddd"
+header_size = struct.calcsize(header_format)
+step_format = "<q"
+step_size = struct.calcsize(step_format)
+
+# Returns the size in bytes of one frame of a table with num_balls balls
+def frame_size(num_balls):
+    return step_size + 4 * 4 * num_balls
+
+# Converts a list of floats to little endian float32 bytes
+def pack_floats(values):
+    data = array("f", values)
+    if (sys.byteorder == "big"):
+        data.byteswap()
+    return data.tostring()
+
+# Writes frames of a simulation to a trajectory file
+# Args: path - the trajectory file, length, width - table size, num_balls - number of balls
+#       every - record a frame every this many steps (0 to disable)
+#       on_collision - also record a frame on every step with a ball-ball collision
+#       resume_step - when a simulation is resumed from a checkpoint, the step it resumes on. The existing
+#                     file is kept up to that step (frames after it are dropped) and new frames are appended
+class TrajectoryWriter:
+    def __init__(self, path, length, width, num_balls, every=500, on_collision=False, resume_step=None):
+        self.num_balls = num_balls
+        self.every = every
+        self.on_collision = on_collision
+        self.last_step = -1
+        self.frames = 0
+        if (resume_step is not None and os.path.isfile(path)):
+            reader = TrajectoryReader(path)
+            if (reader.num_balls != num_balls):
+                reader.close()
+                raise ValueError("%s has %d balls, cannot resume it with %d" % (path, reader.num_balls, num_balls))
+            try:
+                self.frames = reader.find_step(resume_step) + 1
+                self.last_step = reader.step(self.frames - 1)
+            except IndexError:
+                pass
+            reader.close()
+            self.file = open(path, "r+b")
+            self.file.truncate(header_size + self.frames * frame_size(num_balls))
+            self.file.seek(0, os.SEEK_END)
+        else:
+            self.file = open(path, "wb")
+            self.file.write(struct.pack(header_format, magic, version, num_balls, length, width, simulation_step, ball_radius))
+
+    # Records the state of a list of balls after "step" steps
+    def record(self, step, ball_list):
+        values = []
+        for ball in ball_list:
+            values.extend((ball.x, ball.y, ball.x_velocity, ball.y_velocity))
+        self.write_frame(step, values)
+
+    # Records a frame from a flat list of x, y, x velocity, y velocity values (4 per ball)
+    def write_frame(self, step, values):
+        self.write_packed(step, pack_floats(values))
+
+    # Records a frame from values that are already little endian float32 bytes
+    def write_packed(self, step, data):
+        if (step == self.last_step):
+            # Already recorded (e.g. a sampled step that also had a collision)
+            return
+        self.file.write(struct.pack(step_format, step))
+        self.file.write(data)
+        self.last_step = step
+        self.frames = self.frames + 1
+
+    # Returns True if a frame should be recorded after this step
+    def wants(self, step, collided):
+        return (self.every > 0 and step % self.every == 0) or (self.on_collision and collided)
+
+    # Writes the recorded frames to disk
+    def flush(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def close(self):
+        self.file.close()
+
+# Reads a trajectory file. The file is memory mapped, so only the frames that are asked for are read
+class TrajectoryReader:
+    def __init__(self, path):
+        self.file = open(path, "rb")
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        if (len(self.map) < header_size):
+            raise ValueError("%s is not a trajectory file" % path)
+        (file_magic, file_version, self.num_balls, self.length, self.width, self.simulation_step, self.ball_radius) = struct.unpack_from(header_format, self.map, 0)
+        if (file_magic != magic):
+            raise ValueError("%s is not a trajectory file" % path)
+        if (file_version != version):
+            raise ValueError("%s has unsupported trajectory version %d" % (path, file_version))
+        self.frame_size = frame_size(self.num_balls)
+
+    # Number of complete frames in the file
+    def __len__(self):
+        return (len(self.map) - header_size) // self.frame_size
+
+    # Offset of frame k in the file
+    def offset(self, k):
+        if (k < 0 or k >= len(self)):
+            raise IndexError("Frame %d out of range [0,%d)" % (k, len(self)))
+        return header_size + k * self.frame_size
+
+    # Returns the step number of frame k
+    def step(self, k):
+        return struct.unpack_from(step_format, self.map, self.offset(k))[0]
+
+    # Returns frame k as a flat array of x, y, x velocity, y velocity values (4 per ball)
+    def values(self, k):
+        start = self.offset(k) + step_size
+        data = array("f")
+        data.fromstring(self.map[start : start + 16 * self.num_balls])
+        if (sys.byteorder == "big"):
+            data.byteswap()
+        return data
+
+    # Returns frame k as (step, list of balls)
+    def frame(self, k):
+        values = self.values(k)
+        balls = [Ball(values[i], values[i+1], values[i+2], values[i+3]) for i in xrange(0, len(values), 4)]
+        return self.step(k), balls
+
+    # Returns the index of the last frame recorded at or before the given step (binary search, steps only increase)
+    def find_step(self, step):
+        low = 0
+        high = len(self) - 1
+        if (high < 0 or self.step(0) > step):
+            raise IndexError("No frame at or before step %d" % step)
+        while (low < high):
+            middle = (low + high + 1) // 2
+            if (self.step(middle) <= step):
+                low = middle
+            else:
+                high = middle - 1
+        return low
+
+    def close(self):
+        self.map.close()
+        self.file.close()
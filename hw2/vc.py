@@ -21,32 +21,121 @@ REQUIREMENTS:
 Architecture:
 Project/
     .vc_data/
-        branch  [File: Content is name of branch. In this case, main]
-        pending [File: Content keep track of files marked for add or edit]
-        main/  [Dir:  Content is replicate of source control tree, containg history]
-            <fileA.c>/           [Each file is stored as a directory that contains all versions]
-                    fileA.c.ver1     [First version of the file]
-                    fileA.c.ver2
-                    fileA.c.ver3
-                    fileA.c.versions [Each line is the commit message of a version, in double quotes. A * denotes the synced version]
-            <fileB.c>/
-                    fileB.c.ver1
-                    fileB.c.ver2
-                    fileB.c.versions
+        index.db [File: SQLite database with all of the repo's metadata, see indexSchema:
+                   the current branch, the pending files, the settings (see configDefaults), the branches,
+                   the head and synced version of every file in every branch, the commit message and object
+                   id of every version, and where each object is in objects.pack]
+        socket [Unix domain socket of "vc.py serve", only while it runs]
+        objects.pack [File: The contents of every version of every file in every branch, stored once. A full copy every keyframe_interval versions of a file, the line changes from its previous version otherwise]
+        main/  [Dir: Only for versions committed before the object store]
             <fileC.c>/
-                    fileC.c.ver1
-                    fileC.c.versions
+                    fileC.c.ver1.gz  [Versions committed before the object store are in gzipped files, their object
+                    fileC.c.ver2.gz   id in the index is NULL. They are still read, "vc.py migrate" moves them into
+                                      the object store]
     <folderA>/
         fileA.c
     <folderB>/
         fileC.c
         fileB.c
+
+Repos from before the index (with branch and pending files in .vc_data, and <file>.versions and
+<file>.current_version files for every file) are converted to an index the first time they are used, see importIndex.
 '''
 
 import sys
 import os
+import socket
+import struct
+
+#######################################################
+###############  SERVER CLIENT   ######################
+#######################################################
+
+# Unix domain socket of "vc.py serve", relative to the repo (the path of a socket is limited to about 100 characters)
+serverSocketPath = os.path.join(".vc_data", "socket")
+
+# A request to the server is the command and its arguments, separated by NUL bytes. The reply is this header
+# (exit status, length of the output, length of the error output), then the output and the error output
+replyFormat = "<iII"
+replySize = struct.calcsize(replyFormat)
+
+# Reads from a socket until the other side stops sending
+# Args: connection - a connected socket
+# Returns: everything that was received
+def receiveAll(connection):
+    chunks = []
+    while (True):
+        chunk = connection.recv(65536)
+        if (not chunk):
+            return "".join(chunks)
+        chunks.append(chunk)
+
+# Connects to the server of the repo in the current directory
+# Returns: a connected socket, or None if no server is running
+def connectServer():
+    if (not hasattr(socket, "AF_UNIX") or not os.path.exists(serverSocketPath)):
+        return None
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        connection.connect(serverSocketPath)
+    except socket.error:
+        # Left behind by a server that did not stop cleanly
+        connection.close()
+        return None
+    return connection
+
+# Runs a command in the server of the repo, if one is running
+# Args: args - the command and its arguments
+# Returns: (exit status, output, error output) of the command, or None if no server is running
+def forwardCommand(args):
+    connection = connectServer()
+    if (connection is None):
+        return None
+    try:
+        connection.sendall("\0".join(args))
+        connection.shutdown(socket.SHUT_WR)
+        reply = receiveAll(connection)
+    finally:
+        connection.close()
+    if (len(reply) < replySize):
+        sys.exit("Error: The server stopped before the command finished")
+    (status, outputLength, errorLength) = struct.unpack(replyFormat, reply[:replySize])
+    output = reply[replySize:replySize + outputLength]
+    error = reply[replySize + outputLength:replySize + outputLength + errorLength]
+    return status, output, error
+
+# Runs the command in the server of the repo, if it has one, and exits with its exit status
+# Args: args - the command and its arguments, like sys.argv[1:]
+def forwardToServer(args):
+    # setup has no repo yet, and serve (except "serve stop") runs here
+    if (args[:1] == ["setup"] or (args[:1] == ["serve"] and args[1:] != ["stop"])):
+        return
+    reply = forwardCommand(args)
+    if (reply is not None):
+        (status, output, error) = reply
+        sys.stdout.write(output)
+        sys.stderr.write(error)
+        sys.exit(status)
+
+# While the repo has a server (see serve), it runs the command. This is done before importing the modules the
+# commands need, so a forwarded command only costs starting the interpreter and a round trip to the server
+if (__name__ == "__main__" and len(sys.argv) >= 2):
+    forwardToServer(sys.argv[1:])
+
+import gzip
+import Queue
+import signal
+import sqlite3
+import tempfile
+import threading
+import traceback
+import zlib
+import time
 import shutil
+import hashlib
 import difflib
+from collections import OrderedDict
+from cStringIO import StringIO
 
 #######################################################
 #############  DATA STRUCTURES   ######################
@@ -55,6 +144,80 @@ import difflib
 vcDataDir = ""
 pendingPath = ""
 branchPath = ""
+indexPath = ""
+objectsPackPath = ""
+cacheDir = ""
+
+# The index of the repo (a sqlite3 connection), opened by initialized() and closed by closeIndex()
+# All the changes a command makes to it are saved together when the command finishes
+index = None
+
+# The current branch, read from the index the first time it is needed
+workingBranch = None
+
+# objects.pack, open for appending from the first object a command stores until the index is saved
+objectsPackFile = None
+
+# Tables of index.db
+#   settings  - "branch" (the current branch) and the settings of configDefaults
+#   branches  - every branch
+#   pending   - the files marked for add or edit, in the order they were marked
+#   files     - every file in every branch: its head version, the version the user is synced to, and the object
+#               id, size, modification time and time of recording of the user's copy (see recordWorkingFile)
+#   revisions - every version of every file in every branch: its commit message, object id (NULL for
+#               versions stored before the object store) and changeset (NULL for versions committed before
+#               changesets)
+#   changesets - every commit: the branch, the message and the time. All the files of one commit share it
+#   objects   - the offset and length of every object in objects.pack
+indexSchema = """
+CREATE TABLE settings (name TEXT PRIMARY KEY, value TEXT NOT NULL);
+CREATE TABLE branches (name TEXT PRIMARY KEY);
+CREATE TABLE pending (id INTEGER PRIMARY KEY, file TEXT UNIQUE NOT NULL);
+CREATE TABLE files (branch TEXT, file TEXT, head INTEGER NOT NULL, current INTEGER NOT NULL, workstat TEXT, PRIMARY KEY (branch, file));
+CREATE TABLE revisions (branch TEXT, file TEXT, revision INTEGER, message TEXT NOT NULL, object TEXT, changeset INTEGER, PRIMARY KEY (branch, file, revision));
+CREATE TABLE changesets (id INTEGER PRIMARY KEY, branch TEXT NOT NULL, message TEXT NOT NULL, time REAL NOT NULL);
+CREATE INDEX revisions_changeset ON revisions (changeset);
+CREATE TABLE objects (id TEXT PRIMARY KEY, offset INTEGER NOT NULL, length INTEGER NOT NULL);
+"""
+
+# Version of indexSchema, kept in the user_version of index.db
+indexVersion = 1
+
+# Object store: the contents of every version of every file in every branch, stored once per distinct content
+# objects.pack holds the objects one after the other, as pack records (see fullRecord). A delta record is
+# followed by the id of the object it is a delta from. The object id is the SHA-1 of the contents
+objectIdLength = 40
+
+# First byte of an object in objects.pack: a full copy (keyframe) or the line changes from the previous version
+fullRecord = "F"
+deltaRecord = "D"
+
+# Settings of the repo (the settings table of the index) and their defaults
+#   keyframe_interval - a full copy is stored at least every this many versions of a file, so reading a
+#                       version applies at most keyframe_interval - 1 deltas
+#   cache_size        - megabytes of decompressed versions kept in memory by one vc.py process (see cacheLookup)
+#   disk_cache_size   - megabytes of decompressed versions kept in .vc_data/cache, 0 for none
+#   sync_threads      - threads switchbranch decompresses and writes the files of the branch with
+configDefaults = {
+    "keyframe_interval" : 10,
+    "cache_size"        : 64,
+    "disk_cache_size"   : 0,
+    "sync_threads"      : 4
+}
+
+# Smallest value of the settings, 1 if not listed
+configMinimums = {
+    "cache_size"        : 0,
+    "disk_cache_size"   : 0
+}
+
+# Cache of decompressed versions, least recently used first: key (see cacheLookup) -> (contents, number of
+# deltas that were applied to read them)
+revisionCache = OrderedDict()
+revisionCacheBytes = 0
+
+# Lookups of the cache since the process started. A "vc.py serve" process keeps them across commands
+cacheCounters = {"hits": 0, "disk_hits": 0, "misses": 0}
 
 #######################################################
 ########### FILE ACCESS FUNCTIONS #####################
@@ -81,6 +244,31 @@ def appendFile(path, line):
     File.write(line + "\n")
     File.close()
 
+# Opens and reads a whole file as a string, without changing any of its bytes
+# Args: path - the path of a valid file
+# Returns: the file contents
+def readBinary(path):
+    File = open(path, "rb")
+    data = File.read()
+    File.close()
+    return data
+
+# Opens and writes a string to a file, without changing any of its bytes
+# Args: path - the path of a file
+#       data - a string to write
+def writeBinary(path, data):
+    File = open(path, "wb")
+    File.write(data)
+    File.close()
+
+# Opens and appends a string to a file, without changing any of its bytes
+# Args: path - the path of a file
+#       data - a string to append
+def appendBinary(path, data):
+    File = open(path, "ab")
+    File.write(data)
+    File.close()
+
 # Opens and writes data to a file, adding a newline at the end of each line of data
 # Args: path - the path of a valid file
 #       data - a list of data to be written to a file
@@ -91,17 +279,197 @@ def writeFile(path, data):
         File.write(line + "\n")
     File.close()
 
+#######################################################
+###############  INDEX FUNCTIONS   ####################
+#######################################################
+
+# Opens the index of the repo, creating it if needed (see importIndex)
+def openIndex():
+    global index
+    if (not os.path.isfile(indexPath)):
+        # Built under another name and renamed when complete, so a half built index is never used
+        newPath = indexPath + ".new"
+        if (os.path.isfile(newPath)):
+            os.remove(newPath)
+        newIndex = sqlite3.connect(newPath)
+        newIndex.executescript(indexSchema)
+        newIndex.execute("PRAGMA user_version = %d" % indexVersion)
+        oldFiles = importIndex(newIndex)
+        newIndex.commit()
+        newIndex.close()
+        os.rename(newPath, indexPath)
+        # The old metadata files are only removed once the index has everything in them
+        for oldFile in oldFiles:
+            os.remove(oldFile)
+        for (path, dirs, files) in os.walk(vcDataDir, topdown=False):
+            if (path != vcDataDir and not os.listdir(path)):
+                os.rmdir(path)
+    index = sqlite3.connect(indexPath)
+    # Return str like the rest of the program, not unicode
+    index.text_factory = str
+
+# Fills a new index with the metadata of a repo from before the index, if there is one
+# Args: newIndex - a sqlite3 connection to the new index
+# Returns: the old metadata files, to remove once the index is saved
+def importIndex(newIndex):
+    oldFiles = []
+    if (os.path.isfile(branchPath)):
+        newIndex.execute("INSERT INTO settings VALUES ('branch', ?)", (readFile(branchPath)[0].rstrip(),))
+        oldFiles.append(branchPath)
+    else:
+        # New repo
+        newIndex.execute("INSERT INTO settings VALUES ('branch', 'main')")
+        newIndex.execute("INSERT INTO branches VALUES ('main')")
+    if (os.path.isfile(pendingPath)):
+        newIndex.executemany("INSERT OR IGNORE INTO pending (file) VALUES (?)", [(file,) for file in readFile(pendingPath)])
+        oldFiles.append(pendingPath)
+
+    for branchName in os.listdir(vcDataDir):
+        branchDir = os.path.join(vcDataDir, branchName)
+        if (not os.path.isdir(branchDir)):
+            continue
+        newIndex.execute("INSERT INTO branches VALUES (?)", (branchName,))
+        for vFile in os.listdir(branchDir):
+            storePath = os.path.join(branchDir, vFile, vFile)
+            if (not os.path.isfile(storePath + ".versions")):
+                continue
+            messages = readFile(storePath + ".versions")
+            current = len(messages)
+            if (os.path.isfile(storePath + ".current_version")):
+                current = int(readFile(storePath + ".current_version")[0])
+            newIndex.execute("INSERT INTO files VALUES (?, ?, ?, ?, NULL)", (branchName, vFile, len(messages), current))
+            # The versions stay in their .verN.gz files until "vc.py migrate", so they have no object id yet
+            for revision in range(1, len(messages) + 1):
+                newIndex.execute("INSERT INTO revisions VALUES (?, ?, ?, ?, NULL, NULL)", (branchName, vFile, revision, messages[revision - 1]))
+            for extension in (".versions", ".current_version"):
+                if (os.path.isfile(storePath + extension)):
+                    oldFiles.append(storePath + extension)
+    return oldFiles
+
+# Ends the changes of a command to the index, the index stays open
+# Args: save - True to keep the changes made since they were last saved, False to undo them
+def saveIndex(save):
+    global objectsPackFile
+    # The objects are on disk before the index that points to them
+    if (objectsPackFile is not None):
+        objectsPackFile.close()
+        objectsPackFile = None
+    if (save):
+        index.commit()
+    else:
+        index.rollback()
+
+# Closes the index
+# Args: save - True to keep the changes made since it was opened, False to undo them
+def closeIndex(save):
+    global index
+    saveIndex(save)
+    index.close()
+    index = None
+
+# Reads a setting
+# Args: name - the name of the setting
+# Returns: the value of the setting as a string, or None if it is not set
+def getSetting(name):
+    row = index.execute("SELECT value FROM settings WHERE name = ?", (name,)).fetchone()
+    if (row is None):
+        return None
+    return row[0]
+
+# Changes a setting
+# Args: name - the name of the setting
+#       value - the new value
+def setSetting(name, value):
+    index.execute("INSERT OR REPLACE INTO settings VALUES (?, ?)", (name, str(value)))
+
+# Returns True if a branch exists
+def branchExists(branchName):
+    return index.execute("SELECT 1 FROM branches WHERE name = ?", (branchName,)).fetchone() is not None
+
+# Returns the files marked for add or edit, in the order they were marked
+def readPending():
+    return [row[0] for row in index.execute("SELECT file FROM pending ORDER BY id")]
+
+# Unmarks files that were marked for add or edit
+# Args: files - a list of files
+def removeFromPending(files):
+    index.executemany("DELETE FROM pending WHERE file = ?", [(file,) for file in files])
+
+# Reads the versions of a file
+# Args: file - the user file path
+#       branchName - the branch, the current branch by default
+# Returns: (head version, synced version, workstat) or None if the file is not under version control
+def getFileInfo(file, branchName=None):
+    if (branchName is None):
+        branchName = currentWorkingBranch()
+    return index.execute("SELECT head, current, workstat FROM files WHERE branch = ? AND file = ?", (branchName, file)).fetchone()
+
+# Returns the files under version control in a branch
+def listFiles(branchName):
+    return [row[0] for row in index.execute("SELECT file FROM files WHERE branch = ? ORDER BY file", (branchName,))]
+
+# Changes the version of a file the user is synced to
+# Args: file - the user file path
+#       version - the version number
+def setCurrentVersion(file, version):
+    index.execute("UPDATE files SET current = ? WHERE branch = ? AND file = ?", (version, currentWorkingBranch(), file))
+
+# Starts a changeset in the current branch, for the versions one commit adds
+# Args: msg - the commit message
+# Returns: the id of the changeset
+def addChangeset(msg):
+    return index.execute("INSERT INTO changesets (branch, message, time) VALUES (?, ?, ?)", (currentWorkingBranch(), msg, time.time())).lastrowid
+
+# Adds a new head version of a file in the current branch, and syncs the user to it
+# The contents are added by storeFile
+# Args: file - the user file path
+#       revision - the new version number
+#       msg - the commit message
+#       changeset - the id of the changeset the version is part of
+def addRevision(file, revision, msg, changeset):
+    branchName = currentWorkingBranch()
+    index.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, NULL)", (branchName, file, revision, revision))
+    index.execute("INSERT OR REPLACE INTO revisions VALUES (?, ?, ?, ?, NULL, ?)", (branchName, file, revision, msg, changeset))
+
+# Returns the commit messages of the versions of a file in the current branch, version 1 first
+def getMessages(file):
+    return [row[0] for row in index.execute("SELECT message FROM revisions WHERE branch = ? AND file = ? ORDER BY revision", (currentWorkingBranch(), file))]
+
+# Returns the changesets of the versions of a file in the current branch, version 1 first, as
+# (changeset id, number of files in the changeset). The id is None for versions committed before changesets
+def getChangesets(file):
+    return index.execute("SELECT changeset, (SELECT COUNT(*) FROM revisions AS other WHERE other.changeset = revisions.changeset) FROM revisions WHERE branch = ? AND file = ? ORDER BY revision", (currentWorkingBranch(), file)).fetchall()
+
+# Returns the object id of a version of a file, or None if it was stored before the object store
+# Args: branchName - the branch
+#       file - the user file path
+#       revision - the version number
+def getRevisionObject(branchName, file, revision):
+    row = index.execute("SELECT object FROM revisions WHERE branch = ? AND file = ? AND revision = ?", (branchName, file, revision)).fetchone()
+    if (row is None):
+        return None
+    return row[0]
+
+# Sets the object id of a version of a file
+# Args: the same as getRevisionObject, and id - the object id
+def setRevisionObject(branchName, file, revision, id):
+    index.execute("UPDATE revisions SET object = ? WHERE branch = ? AND file = ? AND revision = ?", (id, branchName, file, revision))
+
 #######################################################
 ############  HELPER FUNCTIONS   ######################
 #######################################################
 
 # Checks if the current directory has an associated repo
 # This is done based on the existence of a vcDataDir folder, in the current or parent dir
+# If it exists, the index of the repo is opened
 # Returns True or False based on the existence of the vcDataDir
 def initialized():
     global vcDataDir                        
     global pendingPath
     global branchPath
+    global indexPath
+    global objectsPackPath
+    global cacheDir
 
     if (os.path.isdir(".vc_data") == True):
         # The .vc_data directory exists, meaning we are in a valid repo
@@ -109,6 +477,10 @@ def initialized():
         vcDataDir = os.path.join(os.getcwd(),".vc_data")
         pendingPath = os.path.join(vcDataDir,"pending")
         branchPath = os.path.join(vcDataDir,"branch")
+        indexPath = os.path.join(vcDataDir,"index.db")
+        objectsPackPath = os.path.join(vcDataDir,"objects.pack")
+        cacheDir = os.path.join(vcDataDir,"cache")
+        openIndex()
         return True
     else: 
         # The user is not in an initailized repository
@@ -118,38 +490,45 @@ def initialized():
 # Args: myFile - a string of the file path, relative to root
 # Return: True or False depending on whether the file is under revisionc ontrol
 def isUnderVC(myFile):
-    # If the file is already under version control, it will exist as a
-    # directory with the same filename, in the vcDataDir folder
-    return os.path.isdir(getVcPath(myFile))
+    # If the file is already under version control, it is in the files of the current branch
+    return getFileInfo(myFile) is not None
 
 # Tries to add a file to the pending list. Typically for add or edit
 # Args: myFile - a string of the file path, relative to root
 # Return: True or False depending on whether the action was successful
 def addToPending(myFile):
-    pendingList = readFile(pendingPath)
-    if (myFile in pendingList):
-        return False
-    else:
-        pendingList.append(myFile)
-        writeFile(pendingPath, pendingList)
-        return True
-
-# Find out which branch we are currently using by reading the file
-# the file called 'branch' that contains this information
+    added = index.execute("INSERT OR IGNORE INTO pending (file) VALUES (?)", (myFile,))
+    return added.rowcount == 1
+
+# Reads a setting of the repo
+# Args: name - a key of configDefaults
+# Returns: the value of the setting, or its default if it is not set
+def readConfig(name):
+    value = getSetting(name)
+    if (value is None):
+        return configDefaults[name]
+    return int(value)
+
+# Find out which branch we are currently using, from the index
 # Return: a string for the branch we are on
 def currentWorkingBranch():
-    targetPath = os.path.join(vcDataDir,"branch")
-    currentBranch = readFile(targetPath)[0]
-    currentBranch = currentBranch.rstrip()  #remove new line
-
-    #check if currentBranch actually exists in the vc_data directory
-    fullPath = os.path.join(vcDataDir, currentBranch)
-    if (os.path.isdir(fullPath) == True):
-        return currentBranch
-    else:
-        sys.exit("Error: Branch %r does not exist under version control" % currentBranch)
-
-# Find the proper path that will enable us to put the file under versioning
+    global workingBranch
+    if (workingBranch is None):
+        currentBranch = getSetting("branch")
+        #check if currentBranch actually exists in the index
+        if (not branchExists(currentBranch)):
+            sys.exit("Error: Branch %r does not exist under version control" % currentBranch)
+        workingBranch = currentBranch
+    return workingBranch
+
+# Changes the current branch
+# Args: branchName - the name of an existing branch
+def setWorkingBranch(branchName):
+    global workingBranch
+    setSetting("branch", branchName)
+    workingBranch = branchName
+
+# Find the path where a file was stored before the object store
 # Args: fileToInsert - a string that is the name of a file
 # Return: a string for the vc directory path corresponding to the file
 def getVcPath(fileToInsert):
@@ -163,14 +542,291 @@ def getVcPath(fileToInsert):
 # Args: filename - a string that is the name of a file
 # Returns: an integer, the number of the head revision of the file
 def getHeadRevision(fileName):
-    filePath = getVcPath(fileName)
-    
-    # The number of lines in <path>/<file>.versions denotes the number of versions
-    versionsPath = os.path.join(filePath, fileName + ".versions")
-    versionsFile = readFile(versionsPath)
-    numVersions = len(versionsFile)
+    return getFileInfo(fileName)[0]
+
+# Computes the line changes that turn one version into the next
+# The delta is a list of operations, "c start end\n" copies lines start to end of the old version and
+# "i length\n" is followed by length bytes of new text
+# Args: old, new - the contents of the two versions
+# Returns: the delta
+def makeDelta(old, new):
+    oldLines = old.splitlines(True)
+    newLines = new.splitlines(True)
+    matcher = difflib.SequenceMatcher(None, oldLines, newLines, False)
+    delta = []
+    for (tag, oldStart, oldEnd, newStart, newEnd) in matcher.get_opcodes():
+        if (tag == "equal"):
+            delta.append("c %d %d\n" % (oldStart, oldEnd))
+        elif (newEnd > newStart):
+            # Replaced or inserted lines. Deleted lines are simply not copied
+            text = "".join(newLines[newStart:newEnd])
+            delta.append("i %d\n" % len(text))
+            delta.append(text)
+    return "".join(delta)
+
+# Applies a delta from makeDelta
+# Args: old - the contents of the previous version
+#       delta - the delta
+# Returns: the contents of the next version
+def applyDelta(old, delta):
+    oldLines = old.splitlines(True)
+    new = []
+    position = 0
+    while (position < len(delta)):
+        end = delta.index("\n", position)
+        operation = delta[position:end].split(" ")
+        position = end + 1
+        if (operation[0] == "c"):
+            new.extend(oldLines[int(operation[1]):int(operation[2])])
+        else:
+            length = int(operation[1])
+            new.append(delta[position:position + length])
+            position = position + length
+    return "".join(new)
 
-    return numVersions
+# Reads a version of a file stored before the object store, from its .verN.gz file
+# Args: storePath - the vc path of the file, without extension
+#       revision - a number specifying the revision of the file
+# Returns: (the contents of that version, 0 deltas applied)
+def readStored(storePath, revision):
+    gzipFile = gzip.open(storePath + ".ver" + str(revision) + ".gz", "rb")
+    data = gzipFile.read()
+    gzipFile.close()
+    return data, 0
+
+# Compresses a version for objects.pack, as a delta from the previous version unless a keyframe is due
+# Args: data - the contents of the version
+#       previous - (contents, number of deltas to read it) of the previous version, or None for a full copy
+#       baseId - the object id of the previous version, for the object store
+# Returns: the record to append to objects.pack
+def packRecord(data, previous, baseId=""):
+    full = fullRecord + zlib.compress(data)
+    if (previous is None or previous[1] + 1 >= readConfig("keyframe_interval")):
+        return full
+    delta = deltaRecord + baseId + zlib.compress(makeDelta(previous[0], data))
+    # Completely different versions are smaller as a full copy
+    if (len(delta) < len(full)):
+        return delta
+    return full
+
+# Returns the object id of some contents
+def objectId(data):
+    return hashlib.sha1(data).hexdigest()
+
+# Looks up a version in the cache of decompressed versions, first in memory, then in .vc_data/cache
+# The key is the object id, or branch, file and version for versions stored before the object store. Both
+# never change their contents, so entries never need to be invalidated
+# Args: key - the key of the version
+#       count - False to leave the hit and miss counters alone
+# Returns: (contents, number of deltas applied to read them), or None if the version is not in the cache
+def cacheLookup(key, count=True):
+    if (key in revisionCache):
+        # Now the most recently used
+        entry = revisionCache.pop(key)
+        revisionCache[key] = entry
+        if (count):
+            cacheCounters["hits"] = cacheCounters["hits"] + 1
+        return entry
+
+    if (readConfig("disk_cache_size") > 0):
+        cachePath = os.path.join(cacheDir, hashlib.sha1(key).hexdigest())
+        if (os.path.isfile(cachePath)):
+            cached = readBinary(cachePath)
+            newline = cached.index("\n")
+            entry = (cached[newline + 1:], int(cached[:newline]))
+            # The modification time is the last use, see evictDiskCache
+            os.utime(cachePath, None)
+            storeInMemory(key, entry)
+            if (count):
+                cacheCounters["disk_hits"] = cacheCounters["disk_hits"] + 1
+            return entry
+
+    if (count):
+        cacheCounters["misses"] = cacheCounters["misses"] + 1
+    return None
+
+# Adds a version to the cache of decompressed versions, in memory and in .vc_data/cache
+# Args: key - the key of the version, see cacheLookup
+#       entry - (contents, number of deltas applied to read them)
+def cacheStore(key, entry):
+    storeInMemory(key, entry)
+    diskLimit = readConfig("disk_cache_size") * 1024 * 1024
+    if (diskLimit > 0 and len(entry[0]) <= diskLimit):
+        if (not os.path.isdir(cacheDir)):
+            os.makedirs(cacheDir)
+        cachePath = os.path.join(cacheDir, hashlib.sha1(key).hexdigest())
+        # Written under another name and renamed when complete, so a half written entry is never read
+        writeBinary(cachePath + ".new", "%d\n%s" % (entry[1], entry[0]))
+        os.rename(cachePath + ".new", cachePath)
+        evictDiskCache(diskLimit)
+
+# Adds a version to the cache in memory, and drops the least recently used versions over cache_size
+# Args: the same as cacheStore
+def storeInMemory(key, entry):
+    global revisionCacheBytes
+    limit = readConfig("cache_size") * 1024 * 1024
+    if (len(entry[0]) > limit):
+        return
+    if (key in revisionCache):
+        revisionCacheBytes = revisionCacheBytes - len(revisionCache.pop(key)[0])
+    revisionCache[key] = entry
+    revisionCacheBytes = revisionCacheBytes + len(entry[0])
+    while (revisionCacheBytes > limit):
+        (oldKey, oldEntry) = revisionCache.popitem(False)
+        revisionCacheBytes = revisionCacheBytes - len(oldEntry[0])
+
+# Removes the least recently used versions from .vc_data/cache until it is no larger than limit
+# Args: limit - the size of the cache in bytes
+def evictDiskCache(limit):
+    entries = []
+    total = 0
+    for name in os.listdir(cacheDir):
+        fileStat = os.stat(os.path.join(cacheDir, name))
+        entries.append((fileStat.st_mtime, name, fileStat.st_size))
+        total = total + fileStat.st_size
+    entries.sort()
+    for (mtime, name, size) in entries:
+        if (total <= limit):
+            break
+        os.remove(os.path.join(cacheDir, name))
+        total = total - size
+
+# Reads the records an object is made of from the object store, without decompressing them (see buildObject)
+# Args: id - the object id
+# Returns: (where the deltas start: a full record, or the contents of a version in the cache,
+#           True if it is a full record,
+#           the deltas, compressed, the last one first,
+#           the number of deltas that were applied to read the version in the cache, 0 for a full record)
+def readObjectRecords(id):
+    flushObjects()
+    deltas = []
+    packFile = open(objectsPackPath, "rb")
+    while (True):
+        (offset, length) = index.execute("SELECT offset, length FROM objects WHERE id = ?", (id,)).fetchone()
+        packFile.seek(offset)
+        blob = packFile.read(length)
+        if (blob[0] != deltaRecord):
+            packFile.close()
+            return blob, True, deltas, 0
+        deltas.append(blob[1 + objectIdLength:])
+        id = blob[1:1 + objectIdLength]
+        # The deltas can start from a version in the cache, instead of the last full copy
+        cached = cacheLookup(id, False)
+        if (cached is not None):
+            packFile.close()
+            return cached[0], False, deltas, cached[1]
+
+# Decompresses the records of an object. It does not use the index, so it can run in any thread
+# Args: records - the records of the object, from readObjectRecords
+# Returns: (the contents, the number of deltas that were applied)
+def buildObject(records):
+    (start, isRecord, deltas, depth) = records
+    data = start
+    if (isRecord):
+        data = zlib.decompress(start[1:])
+    for delta in reversed(deltas):
+        data = applyDelta(data, zlib.decompress(delta))
+    return data, depth + len(deltas)
+
+# Reads an object from the object store
+# Args: id - the object id
+# Returns: (the contents, the number of deltas that were applied)
+def readObject(id):
+    cached = cacheLookup(id)
+    if (cached is not None):
+        return cached
+    entry = buildObject(readObjectRecords(id))
+    cacheStore(id, entry)
+    return entry
+
+# Adds contents to the object store, unless they are already in it
+# Args: data - the contents
+#       previousId - the object id of the previous version of the same file, or None. New contents are stored
+#                    as a delta from it, unless a keyframe is due
+# Returns: the object id of the contents
+def storeObject(data, previousId=None):
+    id = objectId(data)
+    if (index.execute("SELECT 1 FROM objects WHERE id = ?", (id,)).fetchone() is not None):
+        return id
+
+    previous = None
+    if (previousId is not None):
+        previous = readObject(previousId)
+    record = packRecord(data, previous, previousId)
+
+    # Objects are only appended, so data of a command that fails is never referenced
+    global objectsPackFile
+    if (objectsPackFile is None):
+        # Kept open, a commit of many files appends all of them with one open and one write to disk
+        objectsPackFile = open(objectsPackPath, "ab")
+        objectsPackFile.seek(0, 2)
+    offset = objectsPackFile.tell()
+    objectsPackFile.write(record)
+    index.execute("INSERT INTO objects VALUES (?, ?, ?)", (id, offset, len(record)))
+    return id
+
+# Writes the objects stored so far to objects.pack, so they can be read
+def flushObjects():
+    if (objectsPackFile is not None):
+        objectsPackFile.flush()
+
+# Reads a version of a file, wherever it is stored
+# Args: branchName - the branch
+#       file - the user file path
+#       revision - a number specifying the revision of the file
+# Returns: the contents of that version
+def readVersion(branchName, file, revision):
+    id = getRevisionObject(branchName, file, revision)
+    if (id is not None):
+        return readObject(id)[0]
+    # Stored before the object store, in its .verN.gz file
+    key = "%s\0%s\0%d" % (branchName, file, revision)
+    cached = cacheLookup(key)
+    if (cached is None):
+        cached = readStored(os.path.join(vcDataDir, branchName, file, file), revision)
+        cacheStore(key, cached)
+    return cached[0]
+
+# Returns the object id of a version of a file
+# Args: file - the user file path
+#       revision - a number specifying the revision of the file
+def getRevisionId(file, revision):
+    id = getRevisionObject(currentWorkingBranch(), file, revision)
+    if (id is not None):
+        return id
+    # Stored before the object store, hash its contents
+    return objectId(readRevision(file, revision))
+
+# Remembers that the user's copy of a file has the contents of an object, along with the size and modification
+# time of the file. As long as they do not change, workingFileId does not need to read the file
+# Args: file - the user file path
+#       id - the object id of the file's contents
+def recordWorkingFile(file, id):
+    fileStat = os.stat(file)
+    workstat = "%s %d %r %r" % (id, fileStat.st_size, fileStat.st_mtime, time.time())
+    index.execute("UPDATE files SET workstat = ? WHERE branch = ? AND file = ?", (workstat, currentWorkingBranch(), file))
+
+# Returns the object id of the contents of the user's copy of a file
+# The file is only hashed if its size or modification time changed since recordWorkingFile, or if it was
+# modified less than a second before that (a later change in the same second might not change the time)
+# Args: file - the user file path
+def workingFileId(file):
+    fileStat = os.stat(file)
+    workstat = getFileInfo(file)[2]
+    if (workstat is not None):
+        (id, size, mtime, recorded) = workstat.split()
+        if (int(size) == fileStat.st_size and float(mtime) == fileStat.st_mtime and fileStat.st_mtime < float(recorded) - 1):
+            return id
+    id = objectId(readBinary(file))
+    recordWorkingFile(file, id)
+    return id
+
+# Reads a version of a file from the repo
+# Args: file - the user file path
+#       revision - a number specifying the revision of the file
+# Returns: the contents of that version
+def readRevision(file, revision):
+    return readVersion(currentWorkingBranch(), file, revision)
 
 # This function stores a user file into the repo.
 # It exists to abstract the underlying algorithm used to compress the files
@@ -179,10 +835,11 @@ def getHeadRevision(fileName):
 def storeFile(file, revision):
     vcPath = getVcPath(file)
     storePath = os.path.join(vcPath,file)
-    # PLEASE NOTE: We only use mode 2, which is the compressed storage
-    # the other modes exist only exist as proof that we evaluated its performance
+    # PLEASE NOTE: We only use mode 4, which adds the version to the object store, in this process
+    # Versions stored with mode 2 (compressed copies) by older repos are still read by readRevision.
+    # The other modes exist only exist as proof that we evaluated their performance
     # (SEE EFFICIENCY SECTION OF DOC)
-    mode = 2
+    mode = 4
     if (mode==1):
         # Store full copies of each version
         storePath = storePath + ".ver" + str(revision)
@@ -204,6 +861,13 @@ def storeFile(file, revision):
             os.system("diff %s %s > %s" % (refPath, file, storePath))
             os.system("gzip %s" % (storePath))
             os.system("gzip %s" % (refPath))
+    elif (mode==4):
+        # Store the contents once in the object store, and record the object id as this version of the file
+        branchName = currentWorkingBranch()
+        previousId = None
+        if (revision > 1):
+            previousId = getRevisionObject(branchName, file, revision - 1)
+        setRevisionObject(branchName, file, revision, storeObject(readBinary(file), previousId))
 
 # This function restores a user file from the repo.
 # It exists to abstract the underlying algorithm used to compress the files
@@ -214,10 +878,8 @@ def restoreFile(file, revision):
     vcPath = getVcPath(file)
     storePath = os.path.join(vcPath,file)
     temp = ""
-    # PLEASE NOTE: We only use mode 2, which is the compressed storage
-    # the other modes exist only exist as proof that we evaluated its performance
-    # (SEE EFFICIENCY SECTION OF DOC)
-    mode = 2
+    # PLEASE NOTE: readRevision reads every mode that was used to store, see storeFile
+    mode = 4
     if (mode==1):
         # Store full copies of each version
         storePath = storePath + ".ver" + str(revision)
@@ -243,6 +905,11 @@ def restoreFile(file, revision):
             os.system("patch %s %s -o %s > /dev/null" % (refPath, storePath, temp))
             os.system("gzip %s" % refPath)
             os.system("gzip %s" % storePath)
+    elif (mode==4):
+        # Seeks and decompresses in the object store (or an older .verN.gz file)
+        (handle, temp) = tempfile.mkstemp(prefix=os.path.basename(file) + ".ver" + str(revision) + ".", dir=vcDataDir)
+        os.close(handle)
+        writeBinary(temp, readRevision(file, revision))
     return temp
 
 # This function is responsible for removing lines
@@ -387,72 +1054,75 @@ def add(args):
             # File does not exist
             print "Warning: No such file \"%s\"" % file
 
-# Commits a file to the repository. Only files marked for add/edit will commit
-# Args: args[0] - A string representing a file name
-#       args[1] - A string representing a commit message
+# Commits files to the repository, as one changeset with one message. Only files marked for add/edit will commit
+# Every file is checked before anything is stored, if any of them cannot be commited none of them are
+# Args: args[0:-1] - the file names, or "--all" for every pending file
+#       args[-1] - A string representing a commit message
 def commit(args): 
-    if len(args) != 2:
-        sys.exit("Error: Commit require 2 arguments: file and message")
+    if len(args) < 2:
+        sys.exit("Error: Commit requires at least 2 arguments: files (or --all) and message")
 
-    file = args[0]
-    msg = args[1]
+    files = args[:-1]
+    msg = args[-1]
 
-    pendingFiles = readFile(pendingPath)
+    pendingFiles = readPending()
 
-    if (file in pendingFiles):
-        # Get the important file paths (versions log, current_version file)
-        vcFilePath = getVcPath(file)
-        curVersionPath = os.path.join(vcFilePath, file + ".current_version")
-        versionsFilePath = os.path.join(vcFilePath, file + ".versions")
+    if (files == ["--all"]):
+        files = pendingFiles
+        if (not files):
+            sys.exit("Error: No files are pending submission")
 
-        if (os.path.isdir(vcFilePath)):
-            # File is marked as pending and the vc path exists, therefore it is an edit
-            versionHistory = readFile(versionsFilePath)
-            headVersion = getHeadRevision(file)
+    # The version each file will get, in the order given. A file given twice is commited once
+    newVersions = []
+    pendingSet = set(pendingFiles)
+    seen = set()
+    for file in files:
+        if (file in seen):
+            continue
+        seen.add(file)
+        if (file not in pendingSet):
+            sys.exit("Error: File \"%s\" has not been marked for edit/add" % file)
 
-            userVersion = int(readFile(curVersionPath)[0])
+        # Get the versions of the file from the index
+        fileInfo = getFileInfo(file)
+
+        if (fileInfo is not None):
+            # File is marked as pending and is in the index, therefore it is an edit
+            (headVersion, userVersion, workstat) = fileInfo
 
             # Check if the user is synced up to head before commiting
             if (userVersion != headVersion):
                 sys.exit("Error: you do not have the most recent version of \"%s\". Please sync before committing." % file)
             
-            # Grab the last commited version of the file and diff it with what the user is committing
+            # Compare the hash of what the user is committing with the hash of the last commited version
             # The user must have changed the file to submit a new version
-            tempPath = restoreFile(file,headVersion)
-            difference = os.system("diff %s %s > /dev/null" % (tempPath, file))
-
-            # Remove the temporary file
-            os.remove(tempPath)
-
-            # If there is no difference, then the user has not changed anything - cancel the submission
-            if (difference == 0):
+            # If the hashes are equal, then the user has not changed anything - cancel the submission
+            if (workingFileId(file) == getRevisionId(file, headVersion)):
                 sys.exit("Error: cannot commit file \"%s\", no change detected from head" % file)
 
             # Increment head version, set as current version
-            # Add new commit message to log and copy over the new version
             headVersion = headVersion + 1
-            writeFile(curVersionPath, [str(headVersion)])
-            appendFile(versionsFilePath, msg)
-            storeFile(file, headVersion)
         else:
-            # File is marked as pending but the vc path does not exist, therefore it is an add
-            # Step 1 - Create the vc file directory
-            os.makedirs(vcFilePath)
+            # File is marked as pending but is not in the index, therefore it is an add
+            headVersion = 1
+        newVersions.append((file, headVersion))
 
-            # Step 2 - Create the necessary vc files (current_version, initial version)
-            writeFile(curVersionPath, ["1"])
+    # Add new commit message to log and copy over the new versions
+    changeset = addChangeset(msg)
+    for (file, headVersion) in newVersions:
+        addRevision(file, headVersion, msg, changeset)
+        storeFile(file, headVersion)
 
-            # Step 3 - Write the msg into the versions file and store the file in VC
-            writeFile(versionsFilePath, [msg])
-            storeFile(file, 1)
+        # The user's copy is now the head version, remember it for the next commit
+        recordWorkingFile(file, getRevisionId(file, headVersion))
 
-        # Step 4 - Now that the file is commited, remove it from pending 
-        pendingFiles.remove(file)
-        writeFile(pendingPath, pendingFiles)
-    else:
-        sys.exit("Error: File \"%s\" has not been marked for edit/add" % file)
+    # Now that the files are commited, remove them from pending 
+    removeFromPending([file for (file, headVersion) in newVersions])
 
-    print "File \"%s\" commited with message \"%s\"" % (file, msg)
+    for (file, headVersion) in newVersions:
+        print "File \"%s\" commited with message \"%s\"" % (file, msg)
+    if (len(newVersions) > 1):
+        print "Changeset %d: %d files commited" % (changeset, len(newVersions))
 
 # Edits a list of files to the pending list. Checks if each argument is a
 # file that exists under vc, and ignores everything that does not
@@ -469,11 +1139,7 @@ def edit(args):
             # Argument is a file that exists, we do not store directories
             if (isUnderVC(file)):
                 # Check if file's current version is at the HEAD revision
-                # path is the root directory which contains all our data for this file
-                path = getVcPath(file)
-                currentVersionPath = os.path.join(path, file + ".current_version")
-                currentVersion = int(readFile(currentVersionPath)[0])
-                numVersions = getHeadRevision(file)
+                (numVersions, currentVersion, workstat) = getFileInfo(file)
 
                 if (numVersions != currentVersion):
                     sys.exit("Error: You can only edit the file if you are the HEAD revision")
@@ -509,14 +1175,11 @@ def sync(args):
         sys.exit("Error: File \"%s\" is not under version control, skipped" % file)
 
     # Check if the file is pending. Only files that are commited can be synced
-    pendingFiles = readFile(pendingPath)
+    pendingFiles = readPending()
 
     if (file in pendingFiles):
         sys.exit("Error: Cannot sync a file that is pending submission. Please commit before syncing")
 
-    # path is the root directory which contains all our data for this file
-    path = getVcPath(file)
-
     # Get the number of versions (head)
     numVersions = getHeadRevision(file)
 
@@ -534,14 +1197,12 @@ def sync(args):
     if (version > numVersions or version < 1):
         sys.exit("Error: No such version \"%s\" of file \"%s\". Valid Range: [1,%s]" % (version, file, numVersions))
 
-    # The value in <path>/<file>.current_version denotes the version we are on, update this
-    currentVersionPath = os.path.join(path, file + ".current_version")
-    writeFile(currentVersionPath, [str(version)])
+    # The current version in the index denotes the version we are on, update this
+    setCurrentVersion(file, version)
 
-    # Now that we have updated the file version, copy over this version of the file to the user
-    tempFile = restoreFile(file,version)
-    os.system("cp %s %s" % (tempFile, file))
-    os.system("rm %s" % tempFile)
+    # Now that we have updated the file version, write this version of the file to the user
+    writeBinary(file, readRevision(file, version))
+    recordWorkingFile(file, getRevisionId(file, version))
 
     print "Synced version %s of file %s" % (version,file)
 
@@ -556,13 +1217,18 @@ def log(args):
     for iterate in args:
         print "%s:" % iterate
         if (isUnderVC(iterate)):
-            # Iterate through the .versions file in reverse order (most recent show up first)
-            vcFilePath = getVcPath(iterate)
-            data = readFile(os.path.join(vcFilePath, iterate+".versions"))
-            count = getHeadRevision(iterate)
+            # Iterate through the commit messages in reverse order (most recent show up first)
+            data = getMessages(iterate)
+            changesets = getChangesets(iterate)
+            count = len(data)
             for line in reversed(data):
                 # Pretty Print format that the user will see
-                print "r%s \"%s\"" % (str(count), line.rstrip())
+                # Versions committed together with other files also show the changeset
+                (changeset, changesetFiles) = changesets[count - 1]
+                if (changesetFiles > 1):
+                    print "r%s \"%s\" (changeset %d, %d files)" % (str(count), line.rstrip(), changeset, changesetFiles)
+                else:
+                    print "r%s \"%s\"" % (str(count), line.rstrip())
                 count = count - 1
         else:
             print "Warning: File \"%s\" is not under version control, skipped" % iterate
@@ -582,29 +1248,27 @@ def branch(args):
         sys.exit("Error: Cannot branch a file that is not under version control")
 
     # Check if the file is pending. Only files that are commited can be branched
-    pendingFiles = readFile(pendingPath)
+    pendingFiles = readPending()
 
     if (file in pendingFiles):
         sys.exit("Error: Cannot branch a file that is pending submission. Please commit before branching")
 
-    # Access the branch file and store its value. We need this to switch back to our original branch context
-    branchFile = os.path.join(vcDataDir, "branch")
-    oldBranch = readFile(branchFile)[0]
+    # Store the current branch. We need this to switch back to our original branch context
+    oldBranch = currentWorkingBranch()
 
     # Only allow alphanumeric branch names
     if (not branchName.isalnum()):
         sys.exit("Error: Invalid branch name \"%s\". Valid characters are alphanumeric" % branchName)
 
-    # Create the branch directory if it does not exist 
-    newBranchPath = os.path.join(vcDataDir, branchName)
-    if (not os.path.isdir(newBranchPath)):
-        os.makedirs(newBranchPath)
+    # Create the branch if it does not exist 
+    index.execute("INSERT OR IGNORE INTO branches VALUES (?)", (branchName,))
 
-    # Change branches by setting the branch file to the user input
-    writeFile(branchFile, [branchName])
+    # Change branches by setting the current branch to the user input
+    setWorkingBranch(branchName)
 
     # Now that we have switched branch contexts, we can add/edit and commit the file naturally 
     # Both these functions require a list as an argument, pass the appropriate values
+    # The contents are already in the object store, so the commit only adds the object id to the new branch
     if isUnderVC(file):
         edit([file])
     else:
@@ -612,16 +1276,15 @@ def branch(args):
 
     commit([file,"Branching %s from %s to %s" % (file,oldBranch,branchName)])
 
-    # Restore to previous branch by setting branch file to previous
-    writeFile(branchFile, [oldBranch])
+    # Restore to previous branch by setting the current branch to previous
+    setWorkingBranch(oldBranch)
 
 # Prints a list of pending files (either add or edit)
 # Args - N/A, not used
 def status(args):
     print "The following files are pending submission:"
-    pendingFiles = readFile(pendingPath)
+    pendingFiles = readPending()
     for file in pendingFiles:
-        file = file.rstrip()
         if (isUnderVC(file)):
             print "\t E " + file
         else:
@@ -634,53 +1297,237 @@ def setup():
         sys.exit("This directory is already under version control")
     else:
         os.makedirs(".vc_data")
-        os.makedirs(".vc_data/main")
         
-    #current branch we are working on by default is called the main
-    writeFile(".vc_data/branch", ["main"])
-    writeFile(".vc_data/pending", [])
+    #creates the index, the current branch we are working on by default is called the main
+    initialized()
+
+# Writes the head version of every file of the current branch to the user's workspace, and syncs the user to it
+# Reading the versions from the object store (which needs the index) is done first, then sync_threads threads
+# decompress the versions and write the files at the same time
+# Args: timings - a list the phases are added to, as (phase, seconds)
+# Returns: the files and their head versions, in the order of listFiles
+def restoreBranch(timings):
+    branchName = currentWorkingBranch()
+    start = time.time()
+    # (file, head version, object id, records to decompress or None, contents if they are already read)
+    jobs = []
+    for vFile in listFiles(branchName):
+        head = getHeadRevision(vFile)
+        id = getRevisionObject(branchName, vFile, head)
+        if (id is None):
+            # Stored before the object store, read here
+            jobs.append((vFile, head, id, None, readVersion(branchName, vFile, head)))
+            continue
+        cached = cacheLookup(id)
+        if (cached is not None):
+            jobs.append((vFile, head, id, None, cached[0]))
+        else:
+            jobs.append((vFile, head, id, readObjectRecords(id), None))
+    timings.append(("read", time.time() - start))
+
+    start = time.time()
+    work = Queue.Queue()
+    for job in jobs:
+        work.put(job)
+    # (object id, (contents, number of deltas) if they were decompressed, exception info if the job failed)
+    results = Queue.Queue()
+    def restoreWorker():
+        while (True):
+            try:
+                (vFile, head, id, records, data) = work.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                entry = None
+                if (records is not None):
+                    entry = buildObject(records)
+                    data = entry[0]
+                writeBinary(vFile, data)
+                results.put((id, entry, None))
+            except Exception:
+                results.put((id, None, sys.exc_info()))
+    threadCount = min(readConfig("sync_threads"), len(jobs))
+    threads = []
+    for i in range(0, threadCount):
+        thread = threading.Thread(target=restoreWorker, name="restore")
+        # A failed job ends the command, the other threads do not keep the process alive
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+    # The decompressed versions go into the cache as they arrive, the cache is not thread safe
+    # Every job gives one result, unless it is dropped after a failed job
+    error = None
+    remaining = len(jobs)
+    while (remaining > 0):
+        (id, entry, jobError) = results.get()
+        remaining = remaining - 1
+        if (jobError is not None and error is None):
+            error = jobError
+            # Drop the jobs that have not started, the command fails
+            while (True):
+                try:
+                    work.get_nowait()
+                except Queue.Empty:
+                    break
+                remaining = remaining - 1
+        if (entry is not None):
+            cacheStore(id, entry)
+    for thread in threads:
+        thread.join()
+    if (error is not None):
+        (errorType, errorValue, errorTraceback) = error
+        raise errorType, errorValue, errorTraceback
+    timings.append(("restore", time.time() - start))
+
+    start = time.time()
+    for (vFile, head, id, records, data) in jobs:
+        setCurrentVersion(vFile, head)
+        recordWorkingFile(vFile, getRevisionId(vFile, head))
+    timings.append(("record", time.time() - start))
+    return [(vFile, head) for (vFile, head, id, records, data) in jobs], threadCount
 
 # Switches the current branch to the specified branch only if it exists
 # Args - args[0]: A string representing a valid branch name
+#        args[1]: "--timings" to show how long each phase of the switch took
 def switchbranch(args):
-    if len(args) != 1:
-        sys.exit("Error: switchbranch requires 1 argument")
+    if (len(args) != 1 and args[1:] != ["--timings"]):
+        sys.exit("Error: switchbranch requires 1 argument, and optionally --timings")
 
-    # Ensure that the pending file is empty in order to allow this to work
-    pendingPath = os.path.join(vcDataDir, "pending")
-    pendingList = readFile(pendingPath)
+    # Ensure that the pending list is empty in order to allow this to work
+    pendingList = readPending()
     if (pendingList):
         sys.exit("Error: Files are still pending for commit. Commit your changes to prevent data loss")
 
     branch = args[0]
-    branchDir = os.path.join(vcDataDir, branch)
     # Check that the branch specified exists
-    if (not os.path.isdir(branchDir) == True):
+    if (not branchExists(branch)):
         sys.exit("Error: The branch specified does not exist in the repository")
 
     # Before switching, we need to remove all versioned files in the user's workspace
+    timings = []
+    start = time.time()
     currentBranch = currentWorkingBranch()
-    currentBranchDir = os.path.join(vcDataDir, currentBranch)
-    versionedFiles = os.listdir(currentBranchDir)
+    versionedFiles = listFiles(currentBranch)
 
     for vFile in versionedFiles:
         # vFile will be all the versioned filenames in the current user directory,
         # we can directly remove them
-        os.system("rm %s " % vFile)
+        if (os.path.isfile(vFile)):
+            os.remove(vFile)
+    timings.append(("remove", time.time() - start))
 
-    # Change the branch file to the branch the user specified
-    writeFile(os.path.join(vcDataDir,"branch"), [branch])
+    # Change the current branch to the branch the user specified
+    setWorkingBranch(branch)
 
     # Sync all the files to HEAD
-    currentBranch = currentWorkingBranch()
-    currentBranchDir = os.path.join(vcDataDir, currentBranch)
-    versionedFiles = os.listdir(currentBranchDir)
-
-    for vFile in versionedFiles:
-        # vFile will be all the versioned filenames that exist 
-        # we can sync them to head directly
-        sync([vFile, "HEAD"])
+    (syncedFiles, threadCount) = restoreBranch(timings)
+    for (vFile, head) in syncedFiles:
+        print "Synced version %s of file %s" % (head, vFile)
     print "Current branch %r is now in use" % branch
+    if (args[1:] == ["--timings"]):
+        print "Timings: %s (%d files, %d threads)" % (", ".join(["%s %.3fs" % timing for timing in timings]), len(syncedFiles), threadCount)
+
+# Shows or changes the settings of the repo
+# Args: no arguments shows every setting
+#       args[0] - the setting to show
+#       args[1] - a new value of the setting
+def config(args):
+    if len(args) > 2:
+        sys.exit("Error: config requires at most 2 arguments: setting and value")
+
+    if (len(args) > 0 and args[0] not in configDefaults):
+        sys.exit("Error: No such setting \"%s\". Valid settings: %s" % (args[0], ", ".join(sorted(configDefaults.keys()))))
+
+    if (len(args) < 2):
+        names = sorted(configDefaults.keys())
+        if (len(args) == 1):
+            names = [args[0]]
+        for name in names:
+            print "%s %s" % (name, readConfig(name))
+        return
+
+    name = args[0]
+    try:
+        value = int(args[1])
+    except ValueError:
+        sys.exit("Error: The value of \"%s\" must be numeric" % name)
+    if (value < configMinimums.get(name, 1)):
+        sys.exit("Error: The value of \"%s\" must be at least %d" % (name, configMinimums.get(name, 1)))
+
+    setSetting(name, value)
+    if (name == "disk_cache_size" and os.path.isdir(cacheDir)):
+        # Shrink the cache to the new size now, not at the next version it stores
+        evictDiskCache(value * 1024 * 1024)
+    print "Setting \"%s\" is now %d" % (name, value)
+
+# Shows the cache of decompressed versions, or empties it
+# The counters are those of this process, so they only add up over several commands in a "vc.py serve" process
+# Args: no arguments shows the counters and sizes of the cache
+#       args[0] - "clear" empties the cache, in memory and in .vc_data/cache
+def cache(args):
+    global revisionCacheBytes
+    if (args == ["clear"]):
+        revisionCache.clear()
+        revisionCacheBytes = 0
+        if (os.path.isdir(cacheDir)):
+            shutil.rmtree(cacheDir)
+        print "Cache cleared"
+        return
+    if (args):
+        sys.exit("Error: cache takes no arguments, or \"clear\"")
+
+    diskBytes = 0
+    diskEntries = 0
+    if (os.path.isdir(cacheDir)):
+        for name in os.listdir(cacheDir):
+            diskBytes = diskBytes + os.path.getsize(os.path.join(cacheDir, name))
+            diskEntries = diskEntries + 1
+    lookups = cacheCounters["hits"] + cacheCounters["disk_hits"] + cacheCounters["misses"]
+    print "Memory: %d versions, %d bytes (limit %d MB)" % (len(revisionCache), revisionCacheBytes, readConfig("cache_size"))
+    print "Disk: %d versions, %d bytes (limit %d MB)" % (diskEntries, diskBytes, readConfig("disk_cache_size"))
+    print "Lookups: %d, hits %d, disk hits %d, misses %d" % (lookups, cacheCounters["hits"], cacheCounters["disk_hits"], cacheCounters["misses"])
+
+# Checks if the versions of a file are all in the object store
+# Args: branchName - the branch
+#       file - the user file path
+# Returns: True if migrate has nothing to do for the file
+def isMigrated(branchName, file):
+    return index.execute("SELECT 1 FROM revisions WHERE branch = ? AND file = ? AND object IS NULL", (branchName, file)).fetchone() is None
+
+# Moves every version of a file into the object store
+# The object ids are saved in the index before the file's .verN.gz files are removed, so the file
+# can always be read, even if this is interrupted
+# Args: branchName - the branch
+#       file - the user file path
+#       numVersions - the number of versions of the file
+def migrateFile(branchName, file, numVersions):
+    previousId = None
+    for revision in range(1, numVersions + 1):
+        previousId = storeObject(readVersion(branchName, file, revision), previousId)
+        setRevisionObject(branchName, file, revision, previousId)
+    flushObjects()
+    index.commit()
+
+    storePath = os.path.join(vcDataDir, branchName, file, file)
+    oldPaths = [storePath + ".ver" + str(revision) + ".gz" for revision in range(1, numVersions + 1)]
+    for oldPath in oldPaths:
+        if (os.path.isfile(oldPath)):
+            os.remove(oldPath)
+    for path in (os.path.dirname(storePath), os.path.join(vcDataDir, branchName)):
+        if (os.path.isdir(path) and not os.listdir(path)):
+            os.rmdir(path)
+
+# Moves the files of every branch from older storage (.verN.gz files) into the object store
+# Args: N/A, not used
+def migrate(args):
+    migrated = 0
+    for (branchName, vFile, numVersions) in index.execute("SELECT branch, file, head FROM files ORDER BY branch, file").fetchall():
+        if (isMigrated(branchName, vFile)):
+            continue
+        migrateFile(branchName, vFile, numVersions)
+        migrated = migrated + 1
+        print "Migrated %s versions of file \"%s\" in branch %r" % (numVersions, vFile, branchName)
+    print "Migrated %s files" % migrated
 
 # Tries to suggest the next iteration of a file in branch "destination",
 # given the last change applied to that file in branch "source"
@@ -697,9 +1544,8 @@ def suggest(args):
     branchFrom = args[1]
     branchTo   = args[2]
 
-    # Access the branch file and store its value. We need this to switch back to our original branch context
-    branchFile = os.path.join(vcDataDir, "branch")
-    oldBranch = readFile(branchFile)[0]
+    # Store the current branch. We need this to switch back to our original branch context
+    oldBranch = currentWorkingBranch()
 
     # call switchbranch - this will take care of checking if files are on pending list
     # this will verify if both branches exist
@@ -773,6 +1619,102 @@ def suggest(args):
     # and branchTo's HEAD
     return 0
 
+#######################################################
+###############  SERVER FUNCTIONS   ###################
+#######################################################
+
+# Runs a command for a client of the server, the way main() runs it, and saves or undoes its changes to the index
+# Args: args - the command and its arguments
+# Returns: (exit status, output, error output) of the command
+def runCommand(args):
+    global workingBranch
+    output = StringIO()
+    error = StringIO()
+    (sys.stdout, sys.stderr) = (output, error)
+    status = 0
+    try:
+        try:
+            if (args[0] not in commandMap):
+                noSuchCommand(args[0])
+            if (args[0] in ("setup", "serve")):
+                sys.exit("Error: The server cannot run command %r" % args[0])
+            commandMap[args[0]](args[1:])
+            saveIndex(True)
+        except SystemExit, exit:
+            saveIndex(True)
+            # The same exit status and message as the interpreter gives for sys.exit
+            if (exit.code is None):
+                status = 0
+            elif (isinstance(exit.code, int)):
+                status = exit.code
+            else:
+                print >> error, exit.code
+                status = 1
+        except Exception:
+            saveIndex(False)
+            traceback.print_exc()
+            status = 1
+    finally:
+        (sys.stdout, sys.stderr) = (sys.__stdout__, sys.__stderr__)
+        # The next command reads the current branch again
+        workingBranch = None
+    return status, output.getvalue(), error.getvalue()
+
+# Stops the server on SIGTERM the same way as on Ctrl-C
+def stopServer(signalNumber, frame):
+    raise KeyboardInterrupt()
+
+# Runs the commands of clients, one at a time, until "vc.py serve stop", Ctrl-C or SIGTERM
+# The index stays open, and the interpreter does not start again for every command
+# While it runs, every command except setup given in the repo's directory is forwarded to it (see main)
+# Args: no arguments starts the server
+#       args[0] - "stop" stops the server of the repo
+def serve(args):
+    if (args == ["stop"]):
+        # A running server answers this itself
+        sys.exit("Error: No server is running for this repo")
+    if (args):
+        sys.exit("Error: serve takes no arguments, or \"stop\"")
+    if (not hasattr(socket, "AF_UNIX")):
+        sys.exit("Error: serve needs Unix domain sockets")
+
+    connection = connectServer()
+    if (connection is not None):
+        connection.close()
+        sys.exit("Error: A server is already running for this repo")
+    if (os.path.exists(serverSocketPath)):
+        os.remove(serverSocketPath)
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(serverSocketPath)
+    listener.listen(16)
+    signal.signal(signal.SIGTERM, stopServer)
+    print "Serving the repo in %s, stop with Ctrl-C or \"vc.py serve stop\"" % os.getcwd()
+    sys.stdout.flush()
+    saveIndex(True)
+
+    try:
+        while (True):
+            (connection, address) = listener.accept()
+            try:
+                args = receiveAll(connection).split("\0")
+                if (args == ["serve", "stop"]):
+                    connection.sendall(struct.pack(replyFormat, 0, len("Server stopped\n"), 0) + "Server stopped\n")
+                    break
+                (status, output, error) = runCommand(args)
+                connection.sendall(struct.pack(replyFormat, status, len(output), len(error)) + output + error)
+            except socket.error:
+                # The client went away, the command was still run
+                pass
+            finally:
+                connection.close()
+    except KeyboardInterrupt:
+        # Undo what a command that was interrupted did
+        saveIndex(False)
+        print "Server stopped"
+    finally:
+        listener.close()
+        os.remove(serverSocketPath)
+
 #######################################################
 ###############  COMMAND MAP   ########################
 #######################################################
@@ -788,7 +1730,11 @@ commandMap = {
     "log"           : log,          # Done
     "branch"        : branch,       # Done
     "switchbranch"  : switchbranch, # DONE 
-    "suggest"       : suggest       # DONE
+    "suggest"       : suggest,      # DONE
+    "config"        : config,
+    "migrate"       : migrate,
+    "cache"         : cache,
+    "serve"         : serve
 }
 
 #######################################################
@@ -806,17 +1752,33 @@ def main():
     if cmd == "setup":
         # Create the hidden data directory to store all repo information
         setup()
+        closeIndex(True)
     elif cmd in commandMap:
         # User gave a valid command, check if the repo is initalized
         # If it is, setup path environment variables
         if (initialized()):
             # Repo is initalized, execute the command
-            commandMap[cmd](sys.argv[2:])
+            # The changes to the index are saved when it finishes, or exits with an error message (like the
+            # metadata files before the index, what was done until then is kept). They are undone if it crashes
+            try:
+                commandMap[cmd](sys.argv[2:])
+            except SystemExit:
+                closeIndex(True)
+                raise
+            except:
+                closeIndex(False)
+                raise
+            closeIndex(True)
         else:
             sys.exit("Error: This directory does not belong to a repo")
     else:
-        validCmds = "\n\t".join(commandMap.keys())
-        sys.exit("Error - No such command: %s\nValid Commands:\n\t%s" % (sys.argv[1], validCmds))
+        noSuchCommand(cmd)
+
+# Exits with the list of valid commands
+# Args: cmd - the command the user gave
+def noSuchCommand(cmd):
+    validCmds = "\n\t".join(commandMap.keys())
+    sys.exit("Error - No such command: %s\nValid Commands:\n\t%s" % (cmd, validCmds))
 
 if __name__ == "__main__":
     main()